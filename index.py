@@ -4,12 +4,2101 @@ import pandas as pd
 import os
 from datetime import datetime
 import hashlib
+import hmac
 import barcode
 from barcode.writer import ImageWriter
 from PIL import Image, ImageTk
 import matplotlib.pyplot as plt
 from matplotlib.backends.backend_tkagg import FigureCanvasTk
 import numpy as np
+import openpyxl
+import csv
+import json
+import queue
+import bisect
+import heapq
+import zlib
+import zipfile
+import io
+import threading
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Windows
+    fcntl = None
+    import msvcrt
+
+# Keystrokes closer together than this are treated as a barcode scanner burst
+SCAN_MAX_KEY_INTERVAL = 0.05
+SCAN_MIN_LENGTH = 3
+
+# Stock locations - each terminal sells from its own location
+LOCATIONS = ['Store', 'Back Room', 'Warehouse']
+TERMINAL_LOCATION = os.environ.get('INVENTORY_LOCATION', LOCATIONS[0])
+
+# Consecutive failed journal flushes before the UI reports the error
+JOURNAL_ERROR_ALERT_FAILURES = 3
+
+# Lot-tracked stock (perishables), partitioned per location like stock, and the
+# dashboard expiry warning window. LOTS_PATH is the pre-partitioning single file.
+LOTS_DIR = 'lots'
+LOTS_PATH = 'lots.xlsx'
+LOT_COLUMNS = ['SKU', 'Lot', 'Expiry', 'Location', 'Quantity']
+EXPIRY_ALERT_DAYS = 7
+
+# Duplicate product detection: pairs at or above this estimated name similarity are
+# reported, and blocking tokens shared by more products than MAX_BLOCK_SIZE are skipped
+DUPLICATE_THRESHOLD = 0.6
+DUPLICATE_MAX_BLOCK_SIZE = 500
+MINHASH_PERMUTATIONS = 64
+
+# Password hashing cost (PBKDF2-SHA256 iterations), how long a login lets a cashier
+# unlock the terminal without re-running it, and the idle time before the terminal locks
+PASSWORD_HASH_ITERATIONS = int(os.environ.get('PASSWORD_HASH_ITERATIONS', 200000))
+SESSION_MINUTES = 60
+TERMINAL_LOCK_MINUTES = 5
+
+# Backups: what is backed up, how often, and content-defined chunk sizes
+BACKUP_DIR = 'backups'
+BACKUP_PATHS = ['products.xlsx', 'users.xlsx', 'lots', 'backorders.xlsx', 'price_history.xlsx', 'stock',
+                'invoices']
+BACKUP_INTERVAL_MINUTES = 30
+BACKUP_EVERY_N_SALES = 50
+CHUNK_MIN_SIZE = 2 * 1024
+CHUNK_AVG_BITS = 13
+CHUNK_MAX_SIZE = 64 * 1024
+CHUNK_WINDOW = 48
+
+# Lock file serializing data file writes across processes, and the shared invoice number counter
+STORE_LOCK_PATH = 'store.lock'
+INVOICE_COUNTER_PATH = os.path.join('invoices', 'next_invoice.json')
+INVOICE_COUNTER_LOCK_PATH = 'invoice_counter.lock'
+
+# Invoices are stored in one partition per period (pandas period alias, e.g. 'M', 'Q').
+# Lines holds the sold items as a JSON list of {"sku", "quantity"} objects
+INVOICE_DIR = 'invoices'
+INVOICE_PARTITION_PERIOD = os.environ.get('INVOICE_PARTITION_PERIOD', 'M')
+INVOICE_COLUMNS = ['Invoice_ID', 'Date', 'Customer_Name', 'Items', 'Total_Amount', 'Payment_Type', 'Lines', 'Lots']
+
+# Price and cost history; prices recorded before history existed are dated from PRICE_HISTORY_START
+PRICE_HISTORY_PATH = 'price_history.xlsx'
+PRICE_HISTORY_COLUMNS = ['SKU', 'Effective_From', 'Effective_To', 'Price', 'Cost']
+PRICE_HISTORY_START = pd.Timestamp('1970-01-01')
+PRICE_CHECK_INTERVAL_SECONDS = 60
+
+# Bulk order ingestion: lines that cannot be filled are rejected or kept as backorders
+BACKORDERS_PATH = 'backorders.xlsx'
+BACKORDER_COLUMNS = ['Order_ID', 'Date', 'Customer_Name', 'SKU', 'Location', 'Quantity', 'Channel']
+ORDER_LINE_COLUMNS = ['Order_ID', 'SKU', 'Quantity']
+
+# Rows held in memory at a time by export jobs
+EXPORT_CHUNK_SIZE = 1000
+
+# Matches shown by the SKU picker dropdown
+PICKER_MAX_MATCHES = 10
+
+
+def write_excel_atomic(df, path):
+    """Write a DataFrame to Excel via a temp file so readers never see a partial file"""
+    root, ext = os.path.splitext(path)
+    tmp_path = f"{root}.{os.getpid()}-{threading.get_ident()}.tmp{ext}"
+    df.to_excel(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def location_stock_path(location):
+    """Path of the stock partition file for a location"""
+    return os.path.join('stock', f"{location.lower().replace(' ', '_')}.xlsx")
+
+
+def read_location_stock(location):
+    """Read one location's stock partition as a SKU -> Quantity series"""
+    path = location_stock_path(location)
+    if not os.path.exists(path):
+        return pd.Series(dtype='int64', name='Quantity')
+    stock_df = pd.read_excel(path)
+    return stock_df.set_index(stock_df['SKU'].astype(str))['Quantity']
+
+
+def write_location_stock(location, quantities):
+    """Write a SKU -> Quantity series as a location's stock partition"""
+    stock_df = pd.DataFrame({'SKU': quantities.index, 'Quantity': quantities.values})
+    write_excel_atomic(stock_df, location_stock_path(location))
+
+
+def load_stock_matrix(locations=None, keep_missing=False):
+    """Load stock for several locations as a SKU x location matrix.
+
+    With `keep_missing`, cells for SKUs a location has never stocked are NaN
+    instead of 0.
+    """
+    locations = locations or LOCATIONS
+    matrix = pd.DataFrame({location: read_location_stock(location) for location in locations})
+    if keep_missing:
+        return matrix
+    return matrix.fillna(0).astype('int64')
+
+
+def with_stock_totals(products_df, matrix=None):
+    """Products with Quantity set to the total across all locations.
+
+    The Quantity column of products.xlsx only seeds the first location's
+    partition on upgrade; stock changes update the location partitions alone.
+    """
+    if matrix is None:
+        matrix = load_stock_matrix()
+    totals = matrix.sum(axis=1)
+    products_df = products_df.copy()
+    products_df['Quantity'] = products_df['SKU'].astype(str).map(totals).fillna(0).astype('int64')
+    return products_df
+
+
+def low_stock_by_location(matrix, min_stock, stocked=None):
+    """Flag SKU x location cells at or below the SKU's minimum stock.
+
+    If a `stocked` mask is given, only locations that stock the SKU are flagged.
+    """
+    low = matrix.le(min_stock.reindex(matrix.index).fillna(0), axis=0)
+    if stocked is not None:
+        low &= stocked
+    return low
+
+
+def lot_partition_path(location):
+    """Path of the lot partition file for a location"""
+    return os.path.join(LOTS_DIR, f"{location.lower().replace(' ', '_')}.xlsx")
+
+
+def normalize_lots(lots_df):
+    lots_df['SKU'] = lots_df['SKU'].astype(str)
+    lots_df['Lot'] = lots_df['Lot'].astype(str)
+    lots_df['Expiry'] = pd.to_datetime(lots_df['Expiry'], errors='coerce')
+    return lots_df
+
+
+def read_location_lots(location):
+    """Read one location's lots; SKUs are strings and expiry dates are timestamps"""
+    path = lot_partition_path(location)
+    if not os.path.exists(path):
+        return pd.DataFrame(columns=LOT_COLUMNS)
+    return normalize_lots(pd.read_excel(path))
+
+
+def write_location_lots(location, lots_df):
+    os.makedirs(LOTS_DIR, exist_ok=True)
+    write_excel_atomic(lots_df[LOT_COLUMNS], lot_partition_path(location))
+
+
+def read_lots(locations=None):
+    """Read lot-level stock across locations"""
+    frames = [lots_df for lots_df in (read_location_lots(location) for location in locations or LOCATIONS)
+              if not lots_df.empty]
+    if not frames:
+        return pd.DataFrame(columns=LOT_COLUMNS)
+    return pd.concat(frames, ignore_index=True)
+
+
+def add_lots(lots_df, additions):
+    """Add (sku, lot, expiry, location, quantity) rows, merging into existing lots"""
+    additions_df = pd.DataFrame(additions, columns=LOT_COLUMNS)
+    additions_df['SKU'] = additions_df['SKU'].astype(str)
+    additions_df['Lot'] = additions_df['Lot'].astype(str)
+    additions_df['Expiry'] = pd.to_datetime(additions_df['Expiry'])
+    lots_df = pd.concat([lots_df, additions_df], ignore_index=True)
+    return lots_df.groupby(['SKU', 'Lot', 'Location'], as_index=False).agg(
+        {'Expiry': 'min', 'Quantity': 'sum'})[LOT_COLUMNS]
+
+
+def receive_lots(additions):
+    """Add (sku, lot, expiry, location, quantity) rows to their location partitions"""
+    by_location = {}
+    for addition in additions:
+        by_location.setdefault(addition[3], []).append(addition)
+    for location, rows in by_location.items():
+        write_location_lots(location, add_lots(read_location_lots(location), rows))
+
+
+def migrate_legacy_lots():
+    """Split a single lots.xlsx into location partitions"""
+    if not os.path.exists(LOTS_PATH):
+        return
+    legacy_df = normalize_lots(pd.read_excel(LOTS_PATH))
+    receive_lots(list(legacy_df[LOT_COLUMNS].itertuples(index=False, name=None)))
+    os.replace(LOTS_PATH, 'lots.migrated.xlsx')
+
+
+class LotAllocator:
+    """First-expiry-first-out allocation over lots.
+
+    Each (SKU, location) gets a heap of (expiry, row) built on first use, so
+    allocating a line costs O(log lots) per lot it draws from.
+    """
+
+    # Lots without an expiry date are used last
+    NO_EXPIRY = np.iinfo('int64').max
+
+    def __init__(self, lots_df):
+        self.lots_df = lots_df.reset_index(drop=True)
+        self.quantities = self.lots_df['Quantity'].to_numpy(dtype='int64').copy()
+        expiry = self.lots_df['Expiry']
+        self.expiry_keys = np.where(expiry.isna(), self.NO_EXPIRY, expiry.astype('int64'))
+        self.rows_by_key = self.lots_df.groupby(['SKU', 'Location']).indices if len(self.lots_df) else {}
+        self.heaps = {}
+
+    def heap(self, sku, location):
+        key = (sku, location)
+        if key not in self.heaps:
+            rows = self.rows_by_key.get(key, [])
+            heap = [(self.expiry_keys[row], row) for row in rows if self.quantities[row] > 0]
+            heapq.heapify(heap)
+            self.heaps[key] = heap
+        return self.heaps[key]
+
+    def allocate(self, sku, location, quantity):
+        """Draw quantity from the earliest-expiring lots; returns (allocations, unallocated)"""
+        heap = self.heap(str(sku), location)
+        allocations = []
+        while quantity > 0 and heap:
+            _, row = heap[0]
+            take = min(self.quantities[row], quantity)
+            self.quantities[row] -= take
+            quantity -= take
+            allocations.append((self.lots_df.at[row, 'Lot'], self.lots_df.at[row, 'Expiry'], int(take)))
+            if self.quantities[row] == 0:
+                heapq.heappop(heap)
+        return allocations, quantity
+
+    def current_lots(self):
+        """Lots with their quantities after allocation.
+
+        Lots emptied since the allocator was built are kept (at zero) so the
+        rows still line up with the heaps; they are dropped on the next rebuild.
+        """
+        lots_df = self.lots_df.copy()
+        lots_df['Quantity'] = self.quantities
+        return lots_df
+
+
+# Per-location allocators kept between calls, so their heaps survive across sales.
+# Each is keyed by the version of its lot file and rebuilt when the file changes.
+_lot_allocators = {}
+_lot_allocators_lock = threading.Lock()
+
+
+def file_version(path):
+    if not os.path.exists(path):
+        return None
+    stat = os.stat(path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+_catalog_skus = (None, frozenset())
+
+
+def catalog_skus():
+    """SKUs in products.xlsx, reread only when the file changes"""
+    global _catalog_skus
+    version = file_version('products.xlsx')
+    if version is None or _catalog_skus[0] != version:
+        products_df = pd.read_excel('products.xlsx')
+        _catalog_skus = (version, frozenset(products_df['SKU'].astype(str)))
+    return _catalog_skus[1]
+
+
+def location_lot_allocator(location):
+    """The cached allocator for a location's lots, rebuilt if the file changed"""
+    version = file_version(lot_partition_path(location))
+    cached = _lot_allocators.get(location)
+    if cached is None or cached[0] != version:
+        lots_df = read_location_lots(location)
+        cached = (version, LotAllocator(lots_df[lots_df['Quantity'] > 0]))
+        _lot_allocators[location] = cached
+    return cached[1]
+
+
+def expiring_lots(days, today=None):
+    """Lots with stock that expire within `days` days (already expired lots included)"""
+    today = pd.Timestamp(today or datetime.now()).normalize()
+    lots_df = read_lots()
+    lots_df = lots_df[(lots_df['Quantity'] > 0) & (lots_df['Expiry'] <= today + pd.Timedelta(days=days))].copy()
+    lots_df['Days_Left'] = (lots_df['Expiry'] - today).dt.days
+    return lots_df.sort_values(['Expiry', 'SKU'])
+
+
+def apply_stock_changes(changes, allow_negative=False, skip_unknown=False):
+    """Apply (sku, location, delta) changes to the location partitions.
+
+    Only the partitions of the locations involved are read and written;
+    products.xlsx is only read, and only when it changed since the last call.
+    Net stock outs of lot-tracked SKUs draw down lots first-expiry-first-out;
+    the lots each change used are returned as a list aligned with `changes`,
+    one [(lot, expiry, quantity), ...] per change.
+    With `skip_unknown`, changes for SKUs no longer in the product list are
+    logged and dropped instead of failing the whole call.
+    """
+    if not changes:
+        return []
+
+    changes_df = pd.DataFrame(changes, columns=['SKU', 'Location', 'Delta'])
+    changes_df['SKU'] = changes_df['SKU'].astype(str)
+
+    unknown_locations = set(changes_df['Location']) - set(LOCATIONS)
+    if unknown_locations:
+        raise ValueError(f"Unknown location: {', '.join(sorted(unknown_locations))}")
+
+    unknown_skus = set(changes_df['SKU']) - catalog_skus()
+    if unknown_skus and skip_unknown:
+        print(f"Skipping stock changes for deleted products: {', '.join(sorted(unknown_skus))}")
+        changes_df = changes_df[~changes_df['SKU'].isin(unknown_skus)]
+        if changes_df.empty:
+            return [[] for _ in changes]
+    elif unknown_skus:
+        raise ValueError(f"Product not found: {', '.join(sorted(unknown_skus))}")
+
+    # Validate every location before writing any of them
+    updated = {}
+    for location, location_changes in changes_df.groupby('Location'):
+        deltas = location_changes.groupby('SKU')['Delta'].sum()
+        quantities = read_location_stock(location).add(deltas, fill_value=0).astype('int64')
+        if not allow_negative and (quantities < 0).any():
+            short = ', '.join(quantities[quantities < 0].index)
+            raise ValueError(f"Insufficient stock at {location} for SKU {short}")
+        updated[location] = quantities
+
+    # Draw down lots for net stock outs, line by line so each change knows its lots
+    allocations = [[] for _ in changes]
+    net = changes_df.groupby(['SKU', 'Location'])['Delta'].sum()
+    lot_locations = {location for location in LOCATIONS if os.path.exists(lot_partition_path(location))}
+    outs = net[(net < 0).to_numpy() & net.index.get_level_values('Location').isin(lot_locations)]
+    if len(outs):
+        rows_by_key = changes_df[changes_df['Delta'] < 0].groupby(['SKU', 'Location']).groups
+        with _lot_allocators_lock:
+            touched = set()
+            try:
+                for (sku, location), net_delta in outs.items():
+                    allocator = location_lot_allocator(location)
+                    remaining = -int(net_delta)
+                    for row in rows_by_key[(sku, location)]:
+                        take = min(-int(changes_df.at[row, 'Delta']), remaining)
+                        allocations[row], _ = allocator.allocate(sku, location, take)
+                        remaining -= take
+                        touched.add(location)
+                for location in touched:
+                    allocator = _lot_allocators[location][1]
+                    lots_df = allocator.current_lots()
+                    if (lots_df['Quantity'] == 0).sum() * 2 > len(lots_df):
+                        # Mostly emptied lots - compact the file and rebuild the heaps next time
+                        write_location_lots(location, lots_df[lots_df['Quantity'] > 0])
+                        del _lot_allocators[location]
+                    else:
+                        write_location_lots(location, lots_df)
+                        _lot_allocators[location] = (file_version(lot_partition_path(location)), allocator)
+            except Exception:
+                # The in-memory heaps no longer match the files
+                for location in touched:
+                    _lot_allocators.pop(location, None)
+                raise
+
+    for location, quantities in updated.items():
+        write_location_stock(location, quantities)
+    return allocations
+
+
+def receive_lot(sku, lot, expiry, location, quantity):
+    """Book a received lot into stock at a location"""
+    apply_stock_changes([(sku, location, quantity)])
+    receive_lots([(sku, lot, expiry, location, quantity)])
+
+
+def read_price_history():
+    """Read the price history; SKUs are strings and the interval bounds timestamps"""
+    if not os.path.exists(PRICE_HISTORY_PATH):
+        return pd.DataFrame(columns=PRICE_HISTORY_COLUMNS)
+    history_df = pd.read_excel(PRICE_HISTORY_PATH, dtype={'SKU': str})
+    history_df['Effective_From'] = pd.to_datetime(history_df['Effective_From'])
+    history_df['Effective_To'] = pd.to_datetime(history_df['Effective_To'])
+    return history_df
+
+
+def write_price_history(history_df):
+    """Write the price history, closing each interval where the SKU's next one starts"""
+    history_df = history_df.sort_values(['SKU', 'Effective_From'], kind='stable').reset_index(drop=True)
+    history_df['Effective_To'] = history_df.groupby('SKU')['Effective_From'].shift(-1)
+    write_excel_atomic(history_df[PRICE_HISTORY_COLUMNS], PRICE_HISTORY_PATH)
+
+
+def timestamp_seconds(dates):
+    """Whole seconds since the epoch for a timestamp or array of timestamps"""
+    return np.asarray(pd.to_datetime(dates), dtype='datetime64[s]').astype('int64')
+
+
+class PriceIndex:
+    """Interval index over the price history for point-in-time price and cost lookups.
+
+    Each SKU's intervals are sorted by start, so a single lookup is a bisect
+    over that SKU's start times. Bulk lookups search all SKUs at once with one
+    np.searchsorted over (SKU code, start second) keys.
+    """
+
+    def __init__(self, history_df):
+        history_df = history_df.sort_values(['SKU', 'Effective_From'], kind='stable')
+        self.skus = pd.Index(history_df['SKU'].astype(str).unique())
+        self.codes = self.skus.get_indexer(history_df['SKU'].astype(str)).astype('int64')
+        self.starts = timestamp_seconds(history_df['Effective_From'])
+        ends = history_df['Effective_To'].fillna(pd.Timestamp.max)
+        self.ends = timestamp_seconds(ends)
+        self.keys = (self.codes << 32) | self.starts
+        self.prices = history_df['Price'].to_numpy(dtype='float64')
+        self.costs = history_df['Cost'].to_numpy(dtype='float64')
+
+        # Per-SKU start times for bisect lookups: sku -> (first row, starts)
+        self.intervals = {}
+        bounds = np.flatnonzero(np.diff(self.codes)) + 1
+        for first, last in zip(np.r_[0, bounds], np.r_[bounds, len(self.codes)]):
+            if last > first:
+                self.intervals[self.skus[self.codes[first]]] = (int(first), self.starts[first:last].tolist())
+
+    def lookup(self, sku, when):
+        """(price, cost) in effect for a SKU at a time, or None if it has no history then"""
+        entry = self.intervals.get(str(sku))
+        if entry is None:
+            return None
+        first, starts = entry
+        second = int(timestamp_seconds(when))
+        position = bisect.bisect_right(starts, second) - 1
+        if position < 0 or second >= self.ends[first + position]:
+            return None
+        return float(self.prices[first + position]), float(self.costs[first + position])
+
+    def lookup_many(self, skus, whens):
+        """Price and cost arrays for (SKU, time) pairs; NaN where there is no history"""
+        codes = self.skus.get_indexer(pd.Index(pd.Series(skus).astype(str))).astype('int64')
+        seconds = timestamp_seconds(whens)
+        prices = np.full(len(codes), np.nan)
+        costs = np.full(len(codes), np.nan)
+        if not len(self.keys):
+            return prices, costs
+
+        rows = np.searchsorted(self.keys, (codes << 32) | seconds, side='right') - 1
+        safe_rows = rows.clip(0)
+        found = ((codes >= 0) & (rows >= 0) & (self.codes[safe_rows] == codes) &
+                 (seconds >= self.starts[safe_rows]) & (seconds < self.ends[safe_rows]))
+        prices[found] = self.prices[safe_rows[found]]
+        costs[found] = self.costs[safe_rows[found]]
+        return prices, costs
+
+    def history(self, sku):
+        """A SKU's intervals as (start, end, price, cost) rows, oldest first"""
+        entry = self.intervals.get(str(sku))
+        if entry is None:
+            return []
+        first, starts = entry
+        open_end = timestamp_seconds(pd.Timestamp.max)
+        return [(pd.Timestamp(self.starts[row], unit='s'),
+                 None if self.ends[row] == open_end else pd.Timestamp(self.ends[row], unit='s'),
+                 float(self.prices[row]), float(self.costs[row]))
+                for row in range(first, first + len(starts))]
+
+    def next_change_after(self, when):
+        """Start of the earliest interval after `when`, or None"""
+        later = self.starts[self.starts > int(timestamp_seconds(when))]
+        return pd.Timestamp(later.min(), unit='s') if len(later) else None
+
+
+def apply_due_prices(now=None):
+    """Copy the price and cost in effect now into products.xlsx; returns the SKUs changed"""
+    now = pd.Timestamp(now or datetime.now())
+    index = PriceIndex(read_price_history())
+    products_df = pd.read_excel('products.xlsx')
+    prices, costs = index.lookup_many(products_df['SKU'], np.full(len(products_df), now))
+    due = ~np.isnan(prices) & ((prices != products_df['Price'].to_numpy(dtype='float64')) |
+                               (costs != products_df['Cost'].to_numpy(dtype='float64')))
+    if not due.any():
+        return []
+    # Whole-number prices are read back as int64
+    products_df[['Price', 'Cost']] = products_df[['Price', 'Cost']].astype('float64')
+    products_df.loc[due, 'Price'] = prices[due]
+    products_df.loc[due, 'Cost'] = costs[due]
+    write_excel_atomic(products_df, 'products.xlsx')
+    return products_df.loc[due, 'SKU'].astype(str).tolist()
+
+
+def schedule_price(sku, price, cost, effective_from=None, effective_to=None):
+    """Record a price and cost for a SKU from `effective_from` (default now).
+
+    With `effective_to` the change is temporary (a promotion): the price in
+    effect at that time is restored then, and any changes scheduled inside
+    the window are replaced. Changes already due are applied to products.xlsx.
+    Returns the SKUs whose current price changed.
+    """
+    sku = str(sku)
+    effective_from = pd.Timestamp(effective_from or datetime.now()).floor('s')
+    history_df = read_price_history()
+
+    if not (history_df['SKU'] == sku).any():
+        # First change for this SKU - keep its current price as the price it always had
+        products_df = pd.read_excel('products.xlsx')
+        product = products_df[products_df['SKU'].astype(str) == sku]
+        if product.empty:
+            raise ValueError(f"Product not found: {sku}")
+        history_df = pd.concat([history_df, pd.DataFrame([{
+            'SKU': sku, 'Effective_From': PRICE_HISTORY_START,
+            'Price': float(product['Price'].iloc[0]), 'Cost': float(product['Cost'].iloc[0]),
+        }])], ignore_index=True)
+
+    new_rows = [{'SKU': sku, 'Effective_From': effective_from, 'Price': float(price), 'Cost': float(cost)}]
+    sku_rows = history_df['SKU'] == sku
+    if effective_to is not None:
+        effective_to = pd.Timestamp(effective_to).floor('s')
+        if effective_to <= effective_from:
+            raise ValueError("A price change must end after it starts")
+        restored = PriceIndex(history_df[sku_rows]).lookup(sku, effective_to)
+        if restored:
+            new_rows.append({'SKU': sku, 'Effective_From': effective_to, 'Price': restored[0], 'Cost': restored[1]})
+        replaced = sku_rows & history_df['Effective_From'].between(effective_from, effective_to)
+    else:
+        replaced = sku_rows & (history_df['Effective_From'] == effective_from)
+
+    history_df = pd.concat([history_df[~replaced], pd.DataFrame(new_rows)], ignore_index=True)
+    write_price_history(history_df)
+    return apply_due_prices()
+
+
+def invoice_period(date):
+    """Name of the partition period an invoice date falls in, safe to use as a file name"""
+    timestamp = pd.to_datetime(date, errors='coerce')
+    if pd.isna(timestamp):
+        timestamp = pd.Timestamp.now()
+    period = timestamp.to_period(INVOICE_PARTITION_PERIOD)
+    name = str(period)
+    if '/' in name:
+        # Spans like weeks print as "start/end" - name them by their first day instead
+        name = period.start_time.strftime('%Y-%m-%d')
+    return name
+
+
+def open_invoice_path(period):
+    return os.path.join(INVOICE_DIR, f"{period}.xlsx")
+
+
+def sealed_invoice_path(period):
+    return os.path.join(INVOICE_DIR, f"{period}.csv.gz")
+
+
+def read_invoice_manifest():
+    """Per-period summaries of the sealed invoice partitions"""
+    path = os.path.join(INVOICE_DIR, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def write_invoice_manifest(manifest):
+    path = os.path.join(INVOICE_DIR, 'manifest.json')
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{path}.tmp", path)
+
+
+def invoice_partitions(start=None, end=None):
+    """List (period, path, sealed) partitions overlapping the date range, oldest first"""
+    if not os.path.isdir(INVOICE_DIR):
+        return []
+    partitions = []
+    for filename in os.listdir(INVOICE_DIR):
+        if '.tmp' in filename:
+            continue
+        if filename.endswith('.csv.gz'):
+            period, sealed = filename[:-len('.csv.gz')], True
+        elif filename.endswith('.xlsx'):
+            period, sealed = filename[:-len('.xlsx')], False
+        else:
+            continue
+        span = pd.Period(period, freq=INVOICE_PARTITION_PERIOD)
+        if start is not None and span.end_time < start:
+            continue
+        if end is not None and span.start_time > end:
+            continue
+        partitions.append((period, os.path.join(INVOICE_DIR, filename), sealed))
+    return sorted(partitions)
+
+
+def read_invoice_partition(path, sealed):
+    if sealed:
+        return pd.read_csv(path, dtype={'Invoice_ID': str})
+    return pd.read_excel(path)
+
+
+def read_invoices(start=None, end=None):
+    """Read invoices dated within [start, end], touching only overlapping partitions"""
+    frames = [read_invoice_partition(path, sealed) for _, path, sealed in invoice_partitions(start, end)]
+    if not frames:
+        return pd.DataFrame(columns=INVOICE_COLUMNS)
+    invoices_df = pd.concat(frames, ignore_index=True)
+    if start is not None or end is not None:
+        dates = pd.to_datetime(invoices_df['Date'], errors='coerce')
+        mask = pd.Series(True, index=invoices_df.index)
+        if start is not None:
+            mask &= dates >= start
+        if end is not None:
+            mask &= dates <= end
+        invoices_df = invoices_df[mask]
+    return invoices_df
+
+
+def count_invoices():
+    """Total invoices, using the sealed summaries instead of reading closed periods"""
+    manifest = read_invoice_manifest()
+    total = 0
+    for period, path, sealed in invoice_partitions():
+        if sealed:
+            total += manifest[period]['rows']
+        else:
+            total += count_excel_rows(path)
+    return total
+
+
+def append_invoices(invoices):
+    """Append invoices to their open period partitions, skipping IDs already stored.
+
+    Returns the IDs that were written.
+    """
+    written = []
+    by_period = {}
+    for invoice in invoices:
+        by_period.setdefault(invoice_period(invoice.get('Date')), []).append(invoice)
+
+    for period, period_invoices in by_period.items():
+        path = open_invoice_path(period)
+        if os.path.exists(path):
+            partition_df = pd.read_excel(path)
+        else:
+            partition_df = pd.DataFrame(columns=INVOICE_COLUMNS)
+
+        # Skip invoices already written by an earlier (interrupted) flush
+        existing_ids = set(partition_df['Invoice_ID'].astype(str))
+        new_invoices = [invoice for invoice in period_invoices if invoice['Invoice_ID'] not in existing_ids]
+        if new_invoices:
+            partition_df = pd.concat([partition_df, pd.DataFrame(new_invoices)], ignore_index=True)
+            write_excel_atomic(partition_df, path)
+            written.extend(invoice['Invoice_ID'] for invoice in new_invoices)
+    return written
+
+
+def seal_closed_invoice_periods(now=None):
+    """Compress open partitions of past periods into immutable files with summaries"""
+    current = invoice_period(now or pd.Timestamp.now())
+    manifest = read_invoice_manifest()
+    sealed = []
+    for period, path, is_sealed in invoice_partitions():
+        if is_sealed or period >= current:
+            continue
+        partition_df = pd.read_excel(path)
+        if os.path.exists(sealed_invoice_path(period)):
+            # Late invoices for an already sealed period are merged in
+            partition_df = pd.concat([read_invoice_partition(sealed_invoice_path(period), True), partition_df],
+                                     ignore_index=True)
+            # Rows merged by an earlier seal that crashed before removing the open partition
+            partition_df = partition_df[~partition_df['Invoice_ID'].astype(str).duplicated()]
+        partition_df = partition_df.sort_values('Date', kind='stable')
+
+        tmp_path = os.path.join(INVOICE_DIR, f"{period}.tmp.csv.gz")
+        partition_df.to_csv(tmp_path, index=False, compression='gzip')
+        os.replace(tmp_path, sealed_invoice_path(period))
+
+        manifest[period] = {
+            'rows': len(partition_df),
+            'total_amount': float(partition_df['Total_Amount'].sum()),
+            'first_date': str(partition_df['Date'].min()) if len(partition_df) else None,
+            'last_date': str(partition_df['Date'].max()) if len(partition_df) else None,
+        }
+        write_invoice_manifest(manifest)
+        os.remove(path)
+        sealed.append(period)
+    return sealed
+
+
+def migrate_legacy_invoices():
+    """Split a single invoices.xlsx into period partitions"""
+    os.makedirs(INVOICE_DIR, exist_ok=True)
+    if not os.path.exists('invoices.xlsx'):
+        return
+    legacy_df = pd.read_excel('invoices.xlsx')
+    if not legacy_df.empty:
+        append_invoices(legacy_df.to_dict('records'))
+    os.replace('invoices.xlsx', 'invoices.migrated.xlsx')
+
+
+def apply_sales_batch(entries, journal=None):
+    """Apply a batch of journaled sales to the invoice and product files in one pass.
+
+    Stock is decremented before the invoices are written. The journal's
+    stock checkpoint records which entries' stock has been applied, so a
+    retry after a failure in between does not lose or repeat a decrement.
+    """
+    if not entries:
+        return
+
+    # Record what was sold on the invoice so it can be revalued later
+    for entry in entries:
+        entry['invoice'].setdefault('Lines', json.dumps([{'sku': str(item['sku']), 'quantity': int(item['quantity'])}
+                                                         for item in entry['items']]))
+
+    # Decrement stock at the selling location - the sale is already acknowledged,
+    # so it is recorded even if the location runs negative or the product was deleted since
+    stock_seq = journal.stock_seq if journal is not None else 0
+    stock_entries = [entry for entry in entries if entry['seq'] > stock_seq]
+    sold = [(entry, item) for entry in stock_entries for item in entry['items']]
+    changes = [(item['sku'], item.get('location', TERMINAL_LOCATION), -item['quantity']) for _, item in sold]
+    allocations = apply_stock_changes(changes, allow_negative=True, skip_unknown=True)
+    if journal is not None and stock_entries:
+        journal.mark_stock_applied(stock_entries[-1]['seq'])
+
+    # Record the lots each sale drew on its invoice (a retry of an already applied
+    # stock step no longer knows them, so those invoices go without)
+    lots_by_invoice = {}
+    for (entry, item), lots_used in zip(sold, allocations):
+        for lot, expiry, quantity in lots_used:
+            lots_by_invoice.setdefault(id(entry), []).append({
+                'sku': str(item['sku']), 'lot': lot, 'quantity': quantity,
+                'expiry': None if pd.isna(expiry) else pd.Timestamp(expiry).strftime('%Y-%m-%d'),
+            })
+    for entry in stock_entries:
+        if id(entry) in lots_by_invoice:
+            entry['invoice']['Lots'] = json.dumps(lots_by_invoice[id(entry)])
+
+    # Only the open partition(s) of the batch's period are read and rewritten;
+    # invoices already stored by an interrupted flush are skipped
+    append_invoices([entry['invoice'] for entry in entries])
+
+
+def lock_file(f, blocking=True):
+    """Take an exclusive OS lock on an open file; raises BlockingIOError if held and not blocking"""
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+        return
+    while True:
+        try:
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            return
+        except OSError:
+            if not blocking:
+                raise BlockingIOError(f"{f.name} is locked")
+            time.sleep(0.05)
+
+
+def unlock_file(f):
+    if fcntl is not None:
+        fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+    else:
+        f.seek(0)
+        msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+
+
+class InterProcessLock:
+    """Reentrant lock shared by threads and by every process using the same lock file"""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.RLock()
+        self._depth = 0
+        self._file = None
+
+    def acquire(self, blocking=True):
+        if not self._lock.acquire(blocking):
+            return False
+        if self._depth == 0:
+            self._file = open(self.path, 'a+')
+            try:
+                lock_file(self._file, blocking)
+            except BlockingIOError:
+                self._file.close()
+                self._file = None
+                self._lock.release()
+                return False
+        self._depth += 1
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth == 0:
+            unlock_file(self._file)
+            self._file.close()
+            self._file = None
+        self._lock.release()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class SalesJournal:
+    """Write-behind journal for sales with a background group-commit flusher.
+
+    Sales are appended to a local fsync'd JSON-lines journal and acknowledged
+    immediately. A flusher thread applies pending entries to the main store in
+    batches and records the last applied sequence number in a checkpoint file.
+    The checkpoint also records the last entry whose stock has been applied,
+    for batches that fail part way. On startup, entries past the checkpoint
+    are replayed.
+
+    Only one process may use a journal file at a time. Data file writes are
+    serialized across processes by the store lock, and invoice numbers come
+    from a counter file shared by every journal on the same data directory.
+    """
+
+    def __init__(self, path, apply_batch, flush_interval=2.0, max_batch=200):
+        self.path = path
+        self.checkpoint_path = f"{path}.ckpt"
+        self.apply_batch = apply_batch
+        self.flush_interval = flush_interval
+        self.max_batch = max_batch
+
+        # Guards read-modify-write cycles on the data files, across processes too
+        self.store_lock = InterProcessLock(STORE_LOCK_PATH)
+        self.journal_lock = InterProcessLock(f"{path}.lock")
+        self.counter_lock = InterProcessLock(INVOICE_COUNTER_LOCK_PATH)
+        self.count_invoices = None
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._file = None
+
+        self.pending = []
+        self.last_seq = 0
+        self.applied_seq = 0
+        self.stock_seq = 0
+
+        # Consecutive failed background flushes and the latest error, shown by the UI
+        self.failed_flushes = 0
+        self.last_error = None
+
+        # Batches applied by the flusher, drained by the UI thread
+        self.applied_batches = queue.Queue()
+
+    def _read_checkpoint(self):
+        if not os.path.exists(self.checkpoint_path):
+            return 0, 0
+        with open(self.checkpoint_path) as f:
+            checkpoint = json.load(f)
+        seq = int(checkpoint.get('seq', 0))
+        return seq, max(seq, int(checkpoint.get('stock_seq', 0)))
+
+    def _write_checkpoint(self, seq):
+        tmp_path = f"{self.checkpoint_path}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump({'seq': seq, 'stock_seq': max(seq, self.stock_seq)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def mark_stock_applied(self, seq):
+        """Record that stock for entries up to seq is applied, right after the stock files are written"""
+        self.stock_seq = seq
+        self._write_checkpoint(self.applied_seq)
+
+    def _read_entries(self):
+        entries = []
+        if not os.path.exists(self.path):
+            return entries
+        with open(self.path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entries.append(json.loads(line))
+                except ValueError:
+                    # Torn write at the tail from a crash - nothing after it was acknowledged
+                    break
+        return entries
+
+    def open(self, count_invoices):
+        """Replay unapplied entries, then open the journal for appending"""
+        if not self.journal_lock.acquire(blocking=False):
+            raise RuntimeError(f"Sales journal {self.path} is in use by another process")
+        self.count_invoices = count_invoices
+        self.applied_seq, self.stock_seq = self._read_checkpoint()
+        unapplied = [e for e in self._read_entries() if e['seq'] > self.applied_seq]
+
+        if unapplied:
+            try:
+                with self.store_lock:
+                    self.apply_batch(unapplied, self)
+            except Exception:
+                self.journal_lock.release()
+                raise
+            self.applied_seq = unapplied[-1]['seq']
+            self._write_checkpoint(self.applied_seq)
+
+        # Everything is applied, so the journal can start empty
+        self._file = open(self.path, 'w')
+        self.last_seq = self.applied_seq
+
+        self._thread = threading.Thread(target=self._run, name='sales-journal-flusher', daemon=True)
+        self._thread.start()
+        return len(unapplied)
+
+    def next_invoice_id(self):
+        """Reserve the next invoice ID from the shared counter, without reading the invoice files"""
+        os.makedirs(os.path.dirname(INVOICE_COUNTER_PATH), exist_ok=True)
+        with self.counter_lock:
+            number = None
+            if os.path.exists(INVOICE_COUNTER_PATH):
+                with open(INVOICE_COUNTER_PATH) as f:
+                    number = int(json.load(f)['next'])
+            if number is None:
+                # First use, or the counter was removed by a restore - continue after the stored invoices
+                number = self.count_invoices() + 1
+            tmp_path = f"{INVOICE_COUNTER_PATH}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'next': number + 1}, f)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, INVOICE_COUNTER_PATH)
+            return f"INV{number:04d}"
+
+    def append(self, invoice, items):
+        """Durably append a sale to the journal and queue it for the flusher"""
+        with self._lock:
+            self.last_seq += 1
+            entry = {'seq': self.last_seq, 'invoice': invoice, 'items': items}
+            self._file.write(json.dumps(entry, default=str) + '\n')
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.pending.append(entry)
+            if len(self.pending) >= self.max_batch:
+                self._wakeup.set()
+        return entry
+
+    def append_many(self, sales):
+        """Durably append many (invoice, items) sales with a single fsync.
+
+        They are queued together, so the next flush applies them as one batch.
+        """
+        with self._lock:
+            entries = []
+            for invoice, items in sales:
+                self.last_seq += 1
+                entries.append({'seq': self.last_seq, 'invoice': invoice, 'items': items})
+            self._file.write(''.join(json.dumps(entry, default=str) + '\n' for entry in entries))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self.pending.extend(entries)
+        return entries
+
+    def flush(self):
+        """Apply all pending entries to the store as a single group commit.
+
+        The batch is taken under the store lock, so a caller already holding
+        it knows no other batch is in flight once this returns.
+        """
+        with self.store_lock:
+            with self._lock:
+                batch = self.pending
+                self.pending = []
+            if not batch:
+                return []
+
+            try:
+                self.apply_batch(batch, self)
+            except Exception:
+                # Put the batch back so the next pass retries it
+                with self._lock:
+                    self.pending = batch + self.pending
+                raise
+            self.applied_seq = batch[-1]['seq']
+            self._write_checkpoint(self.applied_seq)
+
+        # Compact the journal once everything in it has been applied
+        with self._lock:
+            if not self.pending:
+                self._file.seek(0)
+                self._file.truncate()
+
+        self.applied_batches.put(batch)
+        return batch
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+                self.failed_flushes = 0
+                self.last_error = None
+            except Exception as e:
+                self.failed_flushes += 1
+                self.last_error = str(e)
+                print(f"Error flushing sales journal: {e}")
+
+    def close(self):
+        """Stop the flusher and apply anything still pending"""
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+        try:
+            self.flush()
+        finally:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+                self.journal_lock.release()
+
+
+def read_order_lines(path):
+    """Read external order lines from a CSV or JSON-lines file.
+
+    Each line needs Order_ID, SKU and Quantity. Customer_Name, Date,
+    Payment_Type, Location and Channel are optional and default per line.
+    """
+    if path.lower().endswith(('.jsonl', '.ndjson')):
+        lines_df = pd.read_json(path, lines=True, dtype={'Order_ID': str, 'SKU': str})
+    else:
+        lines_df = pd.read_csv(path, dtype={'Order_ID': str, 'SKU': str})
+
+    missing = [col for col in ORDER_LINE_COLUMNS if col not in lines_df.columns]
+    if missing:
+        raise ValueError(f"Order file is missing column(s): {', '.join(missing)}")
+
+    lines_df['Order_ID'] = lines_df['Order_ID'].astype(str).str.strip()
+    lines_df['SKU'] = lines_df['SKU'].astype(str).str.strip()
+    lines_df['Quantity'] = pd.to_numeric(lines_df['Quantity'], errors='coerce')
+    defaults = {
+        'Customer_Name': 'Online Customer',
+        'Payment_Type': 'Online',
+        'Location': TERMINAL_LOCATION,
+        'Channel': os.path.splitext(os.path.basename(path))[0],
+    }
+    for col, default in defaults.items():
+        if col not in lines_df.columns:
+            lines_df[col] = default
+        else:
+            lines_df[col] = lines_df[col].fillna(default)
+
+    # Each date is parsed on its own; blank dates default to now and
+    # unparseable ones become NaT, which plan_order_lines rejects
+    if 'Date' in lines_df.columns:
+        blank = lines_df['Date'].isna()
+        dates = pd.to_datetime(lines_df['Date'], format='mixed', errors='coerce')
+    else:
+        blank = pd.Series(True, index=lines_df.index)
+        dates = pd.Series(pd.NaT, index=lines_df.index, dtype='datetime64[ns]')
+    dates[blank] = pd.Timestamp(datetime.now())
+    lines_df['Date'] = dates.dt.strftime('%Y-%m-%d %H:%M:%S')
+    return lines_df
+
+
+def plan_order_lines(lines_df, products_df, stock_matrix, backorder=False):
+    """Decide how much of every order line can be filled, for the whole batch at once.
+
+    Lines draw on stock at their location in file order. Unknown SKUs or
+    locations, non-positive quantities and unparseable dates are rejected. A line that does not
+    fit in the remaining stock is rejected, or with `backorder` filled as far
+    as stock allows with the rest backordered. Earlier lines keep priority:
+    once a line comes up short, later lines for that SKU and location do too.
+    Adds Filled, Backordered and
+    Reject_Reason columns, plus the Product_Name and Price of each line.
+    """
+    plan_df = lines_df.reset_index(drop=True)
+    catalog = products_df.set_index(products_df['SKU'].astype(str))[['Product_Name', 'Price']]
+    plan_df = plan_df.join(catalog, on='SKU')
+
+    quantity = plan_df['Quantity'].fillna(0)
+    reasons = pd.Series('', index=plan_df.index)
+    # Later checks take precedence, so a bad date is only reported for an otherwise valid line
+    reasons[plan_df['Date'].isna()] = 'invalid date'
+    reasons[~plan_df['Location'].isin(LOCATIONS)] = 'unknown location'
+    reasons[plan_df['Product_Name'].isna()] = 'unknown SKU'
+    reasons[(quantity <= 0) | (quantity != quantity.round())] = 'invalid quantity'
+    valid = reasons == ''
+
+    # Stock left at each line's location before the line, after earlier valid lines
+    stock = stock_matrix.stack()
+    keys = pd.MultiIndex.from_arrays([plan_df['SKU'], plan_df['Location']])
+    available = pd.Series(stock.reindex(keys).fillna(0).to_numpy(), index=plan_df.index).clip(lower=0)
+    demand = quantity.where(valid, 0)
+    earlier = demand.groupby([plan_df['SKU'], plan_df['Location']]).cumsum() - demand
+    remaining = (available - earlier).clip(lower=0)
+
+    if backorder:
+        filled = np.minimum(demand, remaining)
+        backordered = demand - filled
+    else:
+        filled = demand.where(demand <= remaining, 0)
+        backordered = pd.Series(0, index=plan_df.index)
+        reasons[valid & (filled < demand)] = 'insufficient stock'
+    plan_df['Filled'] = filled.astype('int64')
+    plan_df['Backordered'] = backordered.astype('int64')
+    plan_df['Reject_Reason'] = reasons
+    return plan_df
+
+
+def ingest_orders(path, journal, backorder=False, dry_run=False):
+    """Turn a file of external orders into invoices and stock decrements.
+
+    Orders are validated against the products and location stock as one
+    batch, numbered from `journal` like POS sales, and committed through it
+    as a single group commit: every invoice and stock decrement of the batch
+    is applied together, and replayed together after a crash. With `dry_run`
+    nothing is numbered or committed and `journal` may be None. Returns the
+    planned lines and the invoices created.
+    """
+    lines_df = read_order_lines(path)
+    store_lock = journal.store_lock if journal is not None else InterProcessLock(STORE_LOCK_PATH)
+    with store_lock:
+        plan_df = plan_order_lines(lines_df, pd.read_excel('products.xlsx'), load_stock_matrix(), backorder)
+
+        # Orders are charged the price in effect when they were placed, including scheduled prices
+        prices, _ = PriceIndex(read_price_history()).lookup_many(plan_df['SKU'], pd.to_datetime(plan_df['Date']))
+        plan_df['Price'] = pd.Series(prices, index=plan_df.index).fillna(plan_df['Price'])
+
+        filled_df = plan_df[plan_df['Filled'] > 0]
+        sales = []
+        invoice_ids = {}
+        for order_id, order_df in filled_df.groupby('Order_ID', sort=False):
+            first = order_df.iloc[0]
+            invoice = {
+                'Invoice_ID': journal.next_invoice_id() if not dry_run else None,
+                'Date': first['Date'],
+                'Customer_Name': first['Customer_Name'],
+                'Items': ', '.join(f"{name} x{qty}" for name, qty in zip(order_df['Product_Name'],
+                                                                        order_df['Filled'])),
+                'Total_Amount': float((order_df['Price'] * order_df['Filled']).sum()),
+                'Payment_Type': first['Payment_Type'],
+            }
+            items = [{'sku': sku, 'quantity': int(qty), 'location': location}
+                     for sku, qty, location in zip(order_df['SKU'], order_df['Filled'], order_df['Location'])]
+            sales.append((invoice, items))
+            invoice_ids[order_id] = invoice['Invoice_ID']
+        plan_df['Invoice_ID'] = plan_df['Order_ID'].map(invoice_ids)
+
+        if dry_run:
+            return plan_df, [invoice for invoice, _ in sales]
+
+        journal.append_many(sales)
+        journal.flush()
+
+        backorders_df = plan_df[plan_df['Backordered'] > 0]
+        if not backorders_df.empty:
+            backorders_df = backorders_df.assign(Quantity=backorders_df['Backordered'])[BACKORDER_COLUMNS]
+            if os.path.exists(BACKORDERS_PATH):
+                backorders_df = pd.concat([pd.read_excel(BACKORDERS_PATH, dtype={'SKU': str, 'Order_ID': str}),
+                                           backorders_df], ignore_index=True)
+            write_excel_atomic(backorders_df, BACKORDERS_PATH)
+
+    return plan_df, [invoice for invoice, _ in sales]
+
+
+def iter_excel_chunks(path, chunk_size=EXPORT_CHUNK_SIZE):
+    """Stream the first sheet of an Excel file as DataFrame chunks"""
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        rows = workbook.active.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = list(header)
+        chunk = []
+        for row in rows:
+            chunk.append(row)
+            if len(chunk) >= chunk_size:
+                yield pd.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pd.DataFrame(chunk, columns=columns)
+    finally:
+        workbook.close()
+
+
+def count_excel_rows(path):
+    """Number of data rows in an Excel file, read from the sheet dimensions"""
+    workbook = openpyxl.load_workbook(path, read_only=True)
+    try:
+        return max((workbook.active.max_row or 1) - 1, 0)
+    finally:
+        workbook.close()
+
+
+class ExportWriter:
+    """Append DataFrame chunks to a CSV file or a write-only XLSX workbook"""
+
+    def __init__(self, path):
+        self.path = path
+        self.is_xlsx = path.lower().endswith('.xlsx')
+        self.header_written = False
+        self.rows_written = 0
+        if self.is_xlsx:
+            self.workbook = openpyxl.Workbook(write_only=True)
+            self.sheet = self.workbook.create_sheet()
+            self.append_row = self.sheet.append
+        else:
+            self.file = open(path, 'w', newline='', encoding='utf-8')
+            self.append_row = csv.writer(self.file).writerow
+
+    def write(self, chunk):
+        if not self.header_written:
+            self.append_row(list(chunk.columns))
+            self.header_written = True
+        for row in chunk.itertuples(index=False, name=None):
+            self.append_row([None if pd.isna(value) else value for value in row])
+        self.rows_written += len(chunk)
+
+    def close(self):
+        if self.is_xlsx:
+            self.workbook.save(self.path)
+        else:
+            self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def iter_invoice_chunks(start=None, end=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """Stream invoices from the partitions overlapping the date range as DataFrame chunks"""
+    for _, path, sealed in invoice_partitions(start, end):
+        if sealed:
+            yield from pd.read_csv(path, dtype={'Invoice_ID': str}, chunksize=chunk_size)
+        else:
+            yield from iter_excel_chunks(path, chunk_size)
+
+
+def count_partition_rows(start=None, end=None):
+    """Rows in the invoice partitions overlapping the date range, without reading sealed ones"""
+    manifest = read_invoice_manifest()
+    return sum(manifest[period]['rows'] if sealed else count_excel_rows(partition_path)
+               for period, partition_path, sealed in invoice_partitions(start, end))
+
+
+def iter_invoices_between(start=None, end=None, progress=None):
+    """Stream invoice chunks dated between start and end (inclusive days), reporting progress"""
+    range_end = end + pd.Timedelta(days=1) if end is not None else None
+    total = count_partition_rows(start, range_end)
+    done = 0
+    for chunk in iter_invoice_chunks(start, range_end):
+        dates = pd.to_datetime(chunk['Date'], errors='coerce')
+        mask = pd.Series(True, index=chunk.index)
+        if start is not None:
+            mask &= dates >= start
+        if end is not None:
+            mask &= dates < range_end
+        yield chunk[mask]
+        done += len(chunk)
+        if progress:
+            progress(done, total)
+
+
+def export_invoices(path, start=None, end=None, progress=None):
+    """Export invoices dated between start and end (inclusive days)"""
+    with ExportWriter(path) as writer:
+        for chunk in iter_invoices_between(start, end, progress):
+            writer.write(chunk)
+        return writer.rows_written
+
+
+def parse_invoice_lines(value):
+    """(SKU, quantity) pairs from an invoice's Lines cell, JSON or the older "SKU:qty;..." text"""
+    value = str(value)
+    if value.startswith('['):
+        return [(str(line['sku']), line['quantity']) for line in json.loads(value)]
+    return [tuple(pair.rsplit(':', 1)) for pair in value.split(';') if pair]
+
+
+def export_invoice_margin(path, start=None, end=None, progress=None):
+    """Export invoice lines valued at the price and cost in effect on each invoice date"""
+    index = PriceIndex(read_price_history())
+
+    # SKUs without history have only ever had their current price
+    products_df = pd.read_excel('products.xlsx')
+    current = products_df.set_index(products_df['SKU'].astype(str))[['Price', 'Cost']]
+    with ExportWriter(path) as writer:
+        for chunk in iter_invoices_between(start, end, progress):
+            if 'Lines' not in chunk.columns:
+                continue
+            lines = chunk[['Invoice_ID', 'Date', 'Lines']].dropna(subset=['Lines'])
+            lines = lines.assign(Lines=lines['Lines'].map(parse_invoice_lines)).explode('Lines').dropna(subset=['Lines'])
+            if lines.empty:
+                continue
+            report = pd.DataFrame({
+                'Invoice_ID': lines['Invoice_ID'],
+                'Date': lines['Date'],
+                'SKU': lines['Lines'].str[0],
+                'Quantity': pd.to_numeric(lines['Lines'].str[1]),
+            })
+            report['Price'], report['Cost'] = index.lookup_many(report['SKU'], pd.to_datetime(report['Date']))
+            report['Price'] = report['Price'].fillna(report['SKU'].map(current['Price']))
+            report['Cost'] = report['Cost'].fillna(report['SKU'].map(current['Cost']))
+            report['Revenue'] = report['Price'] * report['Quantity']
+            report['Margin'] = report['Revenue'] - report['Cost'] * report['Quantity']
+            writer.write(report)
+        return writer.rows_written
+
+
+def export_stock_valuation(path, start=None, end=None, progress=None):
+    """Export stock value (Quantity x Cost) per product"""
+    total = count_excel_rows('products.xlsx')
+    done = 0
+    matrix = load_stock_matrix()
+    with ExportWriter(path) as writer:
+        for chunk in iter_excel_chunks('products.xlsx'):
+            chunk = with_stock_totals(chunk, matrix)
+            report = chunk[['SKU', 'Product_Name', 'Category', 'Quantity', 'Cost']].copy()
+            report['Value'] = report['Quantity'] * report['Cost']
+            writer.write(report)
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+        return writer.rows_written
+
+
+def export_low_stock(path, start=None, end=None, progress=None):
+    """Export products at or below their minimum stock"""
+    total = count_excel_rows('products.xlsx')
+    done = 0
+    matrix = load_stock_matrix()
+    with ExportWriter(path) as writer:
+        for chunk in iter_excel_chunks('products.xlsx'):
+            chunk = with_stock_totals(chunk, matrix)
+            low = chunk[chunk['Quantity'] <= chunk['Min_Stock']]
+            writer.write(low[['SKU', 'Product_Name', 'Quantity', 'Min_Stock', 'Supplier']])
+            done += len(chunk)
+            if progress:
+                progress(done, total)
+        return writer.rows_written
+
+
+EXPORT_JOBS = {
+    'Invoices': export_invoices,
+    'Invoice Margin': export_invoice_margin,
+    'Stock Valuation': export_stock_valuation,
+    'Low Stock': export_low_stock,
+}
+
+
+# Change events published after data mutations; keys are SKUs or invoice IDs
+PRODUCT_ADDED = 'product_added'
+PRODUCT_UPDATED = 'product_updated'
+PRODUCT_DELETED = 'product_deleted'
+STOCK_CHANGED = 'stock_changed'
+INVOICE_CREATED = 'invoice_created'
+
+
+class ChangeBus:
+    """Publish/subscribe bus for data change events.
+
+    Events published during one UI tick are merged and delivered together
+    from an idle callback, so each subscriber repaints once per tick with the
+    union of the affected keys.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self.subscribers = {}
+        self.pending = {}
+        self.scheduled = False
+
+    def subscribe(self, event_types, handler):
+        """Call handler({event_type: {key: record}}) for any of the given event types"""
+        for event_type in event_types:
+            self.subscribers.setdefault(event_type, []).append(handler)
+
+    def publish(self, event_type, keys, records=None):
+        """Queue an event for the affected keys, with optional records keyed the same way"""
+        records = records or {}
+        pending = self.pending.setdefault(event_type, {})
+        for key in keys:
+            pending[str(key)] = records.get(key)
+        if not self.scheduled:
+            self.scheduled = True
+            self.root.after_idle(self.dispatch)
+
+    def dispatch(self):
+        """Deliver all queued events, calling each subscriber once"""
+        pending = self.pending
+        self.pending = {}
+        self.scheduled = False
+
+        calls = {}
+        for event_type, keyed in pending.items():
+            for handler in self.subscribers.get(event_type, []):
+                calls.setdefault(handler, {})[event_type] = keyed
+
+        for handler, events in calls.items():
+            try:
+                handler(events)
+            except Exception as e:
+                print(f"Error handling change events: {e}")
+
+
+class PrefixIndex:
+    """Sorted prefix index over SKUs and product name words.
+
+    Lookups bisect to the first term with the typed prefix and stop after
+    `limit` distinct SKUs, so cost does not grow with catalog size.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.terms = {}
+        self.names = {}
+
+    def index_terms(self, sku, name):
+        name = str(name).lower()
+        return {sku.lower(), name, *name.split()}
+
+    def build(self, products_df):
+        """Rebuild the index from a products DataFrame"""
+        self.names = dict(zip(products_df['SKU'].astype(str), products_df['Product_Name'].astype(str)))
+        self.terms = {sku: self.index_terms(sku, name) for sku, name in self.names.items()}
+        self.entries = sorted((term, sku) for sku, terms in self.terms.items() for term in terms)
+
+    def add(self, sku, name):
+        """Add or re-index a single product"""
+        sku = str(sku)
+        self.remove(sku)
+        self.names[sku] = str(name)
+        self.terms[sku] = self.index_terms(sku, name)
+        for term in self.terms[sku]:
+            bisect.insort(self.entries, (term, sku))
+
+    def remove(self, sku):
+        """Drop a product from the index"""
+        sku = str(sku)
+        for term in self.terms.pop(sku, ()):
+            i = bisect.bisect_left(self.entries, (term, sku))
+            if i < len(self.entries) and self.entries[i] == (term, sku):
+                del self.entries[i]
+        self.names.pop(sku, None)
+
+    def search(self, prefix, limit=PICKER_MAX_MATCHES):
+        """Return up to `limit` SKUs with a SKU or name word starting with prefix"""
+        prefix = prefix.strip().lower()
+        if not prefix:
+            return []
+        matches = []
+        i = bisect.bisect_left(self.entries, (prefix,))
+        while i < len(self.entries) and len(matches) < limit:
+            term, sku = self.entries[i]
+            if not term.startswith(prefix):
+                break
+            if sku not in matches:
+                matches.append(sku)
+            i += 1
+        return matches
+
+    def label(self, sku):
+        return f"{sku} - {self.names.get(sku, '')}"
+
+
+class SkuPicker(tk.Frame):
+    """Type-ahead product picker backed by a shared PrefixIndex.
+
+    The chosen SKU is kept in `sku`; the entry text is only for display.
+    """
+
+    def __init__(self, master, index, width=30, **kwargs):
+        super().__init__(master, **kwargs)
+        self.index = index
+        self.sku = None
+        self.matches = []
+
+        self.entry = tk.Entry(self, width=width)
+        self.entry.pack()
+        self.listbox = tk.Listbox(self, width=width, height=PICKER_MAX_MATCHES)
+
+        self.entry.bind('<KeyRelease>', self.on_key_release)
+        self.entry.bind('<Return>', self.on_choose)
+        self.entry.bind('<Down>', self.on_focus_list)
+        self.entry.bind('<Escape>', lambda e: self.hide_matches())
+        self.listbox.bind('<Return>', self.on_choose)
+        self.listbox.bind('<Double-1>', self.on_choose)
+        self.listbox.bind('<Escape>', lambda e: self.hide_matches())
+
+    def on_key_release(self, event):
+        if event.keysym in ('Return', 'Down', 'Up', 'Escape'):
+            return
+        self.sku = None
+        self.matches = self.index.search(self.entry.get())
+        self.listbox.delete(0, tk.END)
+        for sku in self.matches:
+            self.listbox.insert(tk.END, self.index.label(sku))
+        if self.matches:
+            self.listbox.pack()
+        else:
+            self.hide_matches()
+
+    def on_focus_list(self, event):
+        if self.matches:
+            self.listbox.focus_set()
+            self.listbox.selection_clear(0, tk.END)
+            self.listbox.selection_set(0)
+            self.listbox.activate(0)
+        return 'break'
+
+    def on_choose(self, event):
+        selection = self.listbox.curselection()
+        if selection:
+            self.select(self.matches[selection[0]])
+        elif self.matches:
+            self.select(self.matches[0])
+        return 'break'
+
+    def select(self, sku):
+        """Set the picked SKU and show its label"""
+        self.sku = sku
+        self.entry.delete(0, tk.END)
+        self.entry.insert(0, self.index.label(sku))
+        self.entry.focus_set()
+        self.hide_matches()
+
+    def hide_matches(self):
+        self.listbox.pack_forget()
+
+    def get_sku(self):
+        """The picked SKU, or the typed text if it is an exact SKU"""
+        if self.sku is not None and self.sku in self.index.names:
+            return self.sku
+        typed = self.entry.get().strip()
+        return typed if typed in self.index.names else None
+
+    def clear(self):
+        self.sku = None
+        self.matches = []
+        self.entry.delete(0, tk.END)
+        self.hide_matches()
+
+
+class StocktakeSession:
+    """Physical count of one location.
+
+    Expected quantities are frozen when the session starts. Scanned counts
+    accumulate in memory, and reconciliation compares them with the
+    location's stock at reconcile time, which already nets out sales and
+    other movements made while counting.
+    """
+
+    def __init__(self, location, full_count=True):
+        self.location = location
+        self.full_count = full_count
+        self.started_at = datetime.now()
+        self.expected = read_location_stock(location)
+        self.counts = {}
+        self.total_counted = 0
+
+    def record(self, sku, quantity=1):
+        """Add counted units for a SKU"""
+        if quantity <= 0:
+            raise ValueError(f"Counted quantity must be positive: {quantity}")
+        sku = str(sku)
+        self.counts[sku] = self.counts.get(sku, 0) + quantity
+        self.total_counted += quantity
+        return self.counts[sku]
+
+    def reconcile(self):
+        """Build the variance report for the whole location in one vectorized pass"""
+        counted = pd.Series(self.counts, dtype='int64')
+        current = read_location_stock(self.location)
+
+        # A full count treats anything not scanned as zero; a cycle count only checks what was scanned
+        if self.full_count:
+            skus = self.expected.index.union(current.index).union(counted.index)
+        else:
+            skus = counted.index
+
+        report = pd.DataFrame({
+            'Expected_At_Start': self.expected.reindex(skus, fill_value=0),
+            'Expected': current.reindex(skus, fill_value=0),
+            'Counted': counted.reindex(skus, fill_value=0),
+        }, index=skus).astype('int64')
+        report.insert(1, 'Movement_During_Count', report['Expected'] - report['Expected_At_Start'])
+        report['Variance'] = report['Counted'] - report['Expected']
+        report.index.name = 'SKU'
+        return report.reset_index()
+
+    def post(self, report):
+        """Post all non-zero variances as a single batched adjustment and save the report"""
+        variances = report[report['Variance'] != 0].copy()
+        variances['Reason'] = np.where(
+            variances['Counted'] == 0, 'Stocktake: not found',
+            np.where(variances['Variance'] > 0, 'Stocktake: surplus', 'Stocktake: shrinkage'))
+
+        apply_stock_changes(list(zip(variances['SKU'], [self.location] * len(variances), variances['Variance'])))
+
+        os.makedirs('stocktakes', exist_ok=True)
+        slug = self.location.lower().replace(' ', '_')
+        path = os.path.join('stocktakes', f"{slug}_{self.started_at.strftime('%Y%m%d_%H%M%S')}.xlsx")
+        write_excel_atomic(variances, path)
+        return variances, path
+
+
+def normalize_names(names):
+    """Lowercase names and reduce them to space-separated alphanumeric words"""
+    return (names.fillna('').astype(str).str.lower()
+            .str.replace(r'[^0-9a-z]+', ' ', regex=True).str.strip())
+
+
+def minhash_signatures(names, permutations=MINHASH_PERMUTATIONS, seed=1):
+    """MinHash signatures over character trigrams, one row per name.
+
+    The fraction of equal columns between two rows estimates the Jaccard
+    similarity of their trigram sets.
+    """
+    # Multiply-shift hashing: uint64 arithmetic wraps mod 2**64, the high bits are kept
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, np.iinfo('uint64').max, permutations, dtype='uint64', endpoint=True) | np.uint64(1)
+    b = rng.integers(0, np.iinfo('uint64').max, permutations, dtype='uint64', endpoint=True)
+    shift = np.uint64(32)
+
+    # Hash every trigram of every name into one flat array, grouped by name
+    hashes = []
+    offsets = np.zeros(len(names), dtype='int64')
+    for i, name in enumerate(names):
+        padded = f"  {name} "
+        offsets[i] = len(hashes)
+        hashes.extend({zlib.crc32(padded[j:j + 3].encode()) for j in range(len(padded) - 2)})
+    hashes = np.array(hashes, dtype='uint64')
+
+    # Minimum per name for each permutation, a few permutations at a time to bound memory
+    signatures = np.empty((len(names), permutations), dtype='uint64')
+    for start in range(0, permutations, 8):
+        stop = min(start + 8, permutations)
+        permuted = (a[start:stop, None] * hashes[None, :] + b[start:stop, None]) >> shift
+        signatures[:, start:stop] = np.minimum.reduceat(permuted, offsets, axis=1).T
+    return signatures
+
+
+def find_duplicate_products(products_df, threshold=DUPLICATE_THRESHOLD, max_block_size=DUPLICATE_MAX_BLOCK_SIZE):
+    """Find likely duplicate products without comparing every pair.
+
+    Products are blocked by (category, name word); only pairs sharing a block
+    are compared, all at once, using MinHash signatures of their names.
+    """
+    products_df = products_df.reset_index(drop=True)
+    names = normalize_names(products_df['Product_Name'])
+    categories = normalize_names(products_df['Category'])
+
+    # Blocking: each product joins one block per distinct word in its name
+    blocks = {}
+    for i, (category, name) in enumerate(zip(categories, names)):
+        for token in set(name.split()):
+            blocks.setdefault((category, token), []).append(i)
+
+    pair_parts = []
+    triangles = {}
+    for members in blocks.values():
+        size = len(members)
+        if 1 < size <= max_block_size:
+            if size not in triangles:
+                triangles[size] = np.triu_indices(size, k=1)
+            left, right = triangles[size]
+            members = np.array(members)
+            pair_parts.append(members[left] * len(products_df) + members[right])
+
+    columns = ['SKU_A', 'Name_A', 'Supplier_A', 'SKU_B', 'Name_B', 'Supplier_B', 'Similarity']
+    if not pair_parts:
+        return pd.DataFrame(columns=columns)
+
+    pair_codes = np.unique(np.concatenate(pair_parts))
+    left, right = np.divmod(pair_codes, len(products_df))
+
+    # Vectorized similarity over every candidate pair
+    signatures = minhash_signatures(names.tolist())
+    similarity = (signatures[left] == signatures[right]).mean(axis=1)
+    keep = similarity >= threshold
+    left, right, similarity = left[keep], right[keep], similarity[keep]
+
+    a = products_df.iloc[left].reset_index(drop=True)
+    b = products_df.iloc[right].reset_index(drop=True)
+    pairs = pd.DataFrame({
+        'SKU_A': a['SKU'].astype(str), 'Name_A': a['Product_Name'], 'Supplier_A': a['Supplier'],
+        'SKU_B': b['SKU'].astype(str), 'Name_B': b['Product_Name'], 'Supplier_B': b['Supplier'],
+        'Similarity': similarity.round(3),
+    })
+    return pairs.sort_values('Similarity', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def merge_products(keep_sku, drop_sku):
+    """Fold a duplicate product into another: stock and lots move over, then it is deleted"""
+    keep_sku, drop_sku = str(keep_sku), str(drop_sku)
+
+    # Re-key lots first so moving the stock below doesn't draw them down
+    for location in LOCATIONS:
+        lots_df = read_location_lots(location)
+        if (lots_df['SKU'] == drop_sku).any():
+            lots_df.loc[lots_df['SKU'] == drop_sku, 'SKU'] = keep_sku
+            write_location_lots(location, add_lots(lots_df, []))
+
+    matrix = load_stock_matrix()
+    changes = []
+    if drop_sku in matrix.index:
+        for location, qty in matrix.loc[drop_sku].items():
+            if qty:
+                changes += [(drop_sku, location, -qty), (keep_sku, location, qty)]
+    apply_stock_changes(changes, allow_negative=True)
+
+    products_df = pd.read_excel('products.xlsx')
+    products_df = products_df[products_df['SKU'].astype(str) != drop_sku]
+    write_excel_atomic(products_df, 'products.xlsx')
+    for location in LOCATIONS:
+        quantities = read_location_stock(location)
+        if drop_sku in quantities.index:
+            write_location_stock(location, quantities.drop(drop_sku))
+
+
+# Random byte weights for the content-defined chunker's rolling window sum
+CHUNK_GEAR = np.random.default_rng(20240101).integers(0, np.iinfo('uint64').max, 256, dtype='uint64',
+                                                       endpoint=True)
+
+
+def chunk_boundaries(data):
+    """Content-defined chunk end offsets, so an edit only changes nearby chunks.
+
+    A boundary falls where the gear-weighted sum of the last CHUNK_WINDOW
+    bytes has its low CHUNK_AVG_BITS bits clear, within the min/max sizes.
+    """
+    if len(data) <= CHUNK_MIN_SIZE:
+        return [len(data)]
+
+    weights = CHUNK_GEAR[np.frombuffer(data, dtype='uint8')]
+    sums = np.cumsum(weights, dtype='uint64')
+    window_sums = sums[CHUNK_WINDOW:] - sums[:-CHUNK_WINDOW]
+    mask = np.uint64((1 << CHUNK_AVG_BITS) - 1)
+    candidates = np.flatnonzero((window_sums & mask) == 0) + CHUNK_WINDOW + 1
+
+    boundaries = []
+    last = 0
+    for candidate in candidates:
+        while candidate - last > CHUNK_MAX_SIZE:
+            last += CHUNK_MAX_SIZE
+            boundaries.append(last)
+        if candidate - last >= CHUNK_MIN_SIZE:
+            boundaries.append(int(candidate))
+            last = int(candidate)
+    while len(data) - last > CHUNK_MAX_SIZE:
+        last += CHUNK_MAX_SIZE
+        boundaries.append(last)
+    if last < len(data):
+        boundaries.append(len(data))
+    return boundaries
+
+
+def backup_files():
+    """Data files covered by backups, relative to the data directory"""
+    files = []
+    for path in BACKUP_PATHS:
+        if os.path.isdir(path):
+            for dirpath, _, filenames in os.walk(path):
+                files.extend(os.path.join(dirpath, name) for name in filenames if '.tmp' not in name)
+        elif os.path.exists(path):
+            files.append(path)
+    return sorted(files)
+
+
+def chunk_path(digest):
+    return os.path.join(BACKUP_DIR, 'chunks', digest[:2], digest)
+
+
+def store_chunks(data):
+    """Store new chunks of data compressed; returns the chunk digests and bytes written"""
+    digests = []
+    written = 0
+    start = 0
+    for end in chunk_boundaries(data):
+        chunk = data[start:end]
+        start = end
+        digest = hashlib.sha256(chunk).hexdigest()
+        digests.append(digest)
+        path = chunk_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            compressed = zlib.compress(chunk, 6)
+            with open(f"{path}.tmp", 'wb') as f:
+                f.write(compressed)
+            os.replace(f"{path}.tmp", path)
+            written += len(compressed)
+    return digests, written
+
+
+def list_snapshots():
+    """Snapshot manifests, newest first"""
+    snapshot_dir = os.path.join(BACKUP_DIR, 'snapshots')
+    if not os.path.isdir(snapshot_dir):
+        return []
+    snapshots = []
+    for filename in sorted(os.listdir(snapshot_dir), reverse=True):
+        if filename.endswith('.json'):
+            with open(os.path.join(snapshot_dir, filename)) as f:
+                snapshot = json.load(f)
+            snapshot['id'] = filename[:-len('.json')]
+            snapshots.append(snapshot)
+    return snapshots
+
+
+def take_snapshot(lock, reason='manual'):
+    """Take an incremental, deduplicated snapshot of the data files.
+
+    Files whose size and mtime match the previous snapshot reuse its chunk
+    list without being read. Changed files are read under `lock` so the
+    snapshot is consistent across files, then chunked and compressed
+    outside it. Workbooks are zip archives, so their members are chunked
+    uncompressed - chunking the deflated bytes would make a one-cell edit
+    change nearly every chunk.
+    """
+    previous = list_snapshots()
+    previous_files = previous[0]['files'] if previous else {}
+
+    files = {}
+    changed = {}
+    with lock:
+        for path in backup_files():
+            stat = os.stat(path)
+            entry = previous_files.get(path)
+            if entry and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                files[path] = entry
+            else:
+                with open(path, 'rb') as f:
+                    changed[path] = (f.read(), stat)
+
+    written = 0
+    for path, (data, stat) in changed.items():
+        entry = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+        if zipfile.is_zipfile(io.BytesIO(data)):
+            entry['members'] = []
+            with zipfile.ZipFile(io.BytesIO(data)) as archive:
+                for name in archive.namelist():
+                    digests, chunk_bytes = store_chunks(archive.read(name))
+                    written += chunk_bytes
+                    entry['members'].append({'name': name, 'chunks': digests})
+        else:
+            entry['chunks'], chunk_bytes = store_chunks(data)
+            written += chunk_bytes
+        files[path] = entry
+
+    created = datetime.now()
+    snapshot = {
+        'created': created.strftime('%Y-%m-%d %H:%M:%S'),
+        'reason': reason,
+        'changed_files': len(changed),
+        'bytes_written': written,
+        'files': files,
+    }
+    snapshot_dir = os.path.join(BACKUP_DIR, 'snapshots')
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot_id = created.strftime('%Y%m%d_%H%M%S_%f')
+    path = os.path.join(snapshot_dir, f"{snapshot_id}.json")
+    with open(f"{path}.tmp", 'w') as f:
+        json.dump(snapshot, f)
+    os.replace(f"{path}.tmp", path)
+    snapshot['id'] = snapshot_id
+    return snapshot
+
+
+def read_chunks(digests):
+    """Reassemble data from stored chunks"""
+    parts = []
+    for digest in digests:
+        with open(chunk_path(digest), 'rb') as f:
+            parts.append(zlib.decompress(f.read()))
+    return b''.join(parts)
+
+
+def restore_snapshot(snapshot_id):
+    """Restore the data files to a snapshot; files created after it are removed"""
+    with open(os.path.join(BACKUP_DIR, 'snapshots', f"{snapshot_id}.json")) as f:
+        snapshot = json.load(f)
+
+    # Rebuild every file next to its target first, so a bad chunk aborts before anything changes
+    staged = []
+    for path, entry in snapshot['files'].items():
+        stat = os.stat(path) if os.path.exists(path) else None
+        if stat and stat.st_size == entry['size'] and stat.st_mtime_ns == entry['mtime_ns']:
+            continue
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        tmp_path = f"{path}.restore.tmp"
+        if 'members' in entry:
+            # Workbooks are re-zipped from their members; the bytes differ but the content is the same
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_DEFLATED) as archive:
+                for member in entry['members']:
+                    archive.writestr(member['name'], read_chunks(member['chunks']))
+        else:
+            with open(tmp_path, 'wb') as out:
+                out.write(read_chunks(entry['chunks']))
+        staged.append((tmp_path, path))
+
+    for tmp_path, path in staged:
+        os.replace(tmp_path, path)
+    for path in set(backup_files()) - set(snapshot['files']):
+        os.remove(path)
+    return snapshot
+
+
+class BackupManager:
+    """Takes snapshots in the background on a schedule and after every N sales"""
+
+    def __init__(self, lock, interval_minutes=BACKUP_INTERVAL_MINUTES, every_n_sales=BACKUP_EVERY_N_SALES):
+        self.lock = lock
+        self.interval = interval_minutes * 60
+        self.every_n_sales = every_n_sales
+        self.sales_since_backup = 0
+        self.requested_reason = None
+        self.last_snapshot = None
+        self.last_error = None
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='backups', daemon=True)
+        self._thread.start()
+
+    def note_sales(self, count):
+        """Count applied sales and request a snapshot every N"""
+        self.sales_since_backup += count
+        if self.every_n_sales and self.sales_since_backup >= self.every_n_sales:
+            self.request('sales')
+
+    def request(self, reason='manual'):
+        self.requested_reason = reason
+        self._wakeup.set()
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if self._stopped.is_set():
+                break
+            reason = self.requested_reason or 'scheduled'
+            self.requested_reason = None
+            self.sales_since_backup = 0
+            try:
+                self.last_snapshot = take_snapshot(self.lock, reason)
+                self.last_error = None
+            except Exception as e:
+                self.last_error = str(e)
+                print(f"Error taking backup: {e}")
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+
+
+def hash_password(password, iterations=PASSWORD_HASH_ITERATIONS):
+    """Salted PBKDF2-SHA256 hash, stored as pbkdf2_sha256$iterations$salt$hash"""
+    salt = os.urandom(16)
+    digest = hashlib.pbkdf2_hmac('sha256', password.encode(), salt, iterations)
+    return f"pbkdf2_sha256${iterations}${salt.hex()}${digest.hex()}"
+
+
+def verify_password(password, stored):
+    """Check a password against a stored hash; legacy unsalted SHA-256 hashes are accepted"""
+    stored = str(stored)
+    if stored.startswith('pbkdf2_sha256$'):
+        _, iterations, salt, expected = stored.split('$')
+        digest = hashlib.pbkdf2_hmac('sha256', password.encode(), bytes.fromhex(salt), int(iterations))
+        return hmac.compare_digest(digest.hex(), expected)
+    return hmac.compare_digest(hashlib.sha256(password.encode()).hexdigest(), stored)
+
+
+def password_needs_rehash(stored, iterations=PASSWORD_HASH_ITERATIONS):
+    """Whether a stored hash is legacy SHA-256 or uses a different cost than configured"""
+    parts = str(stored).split('$')
+    return len(parts) != 4 or parts[0] != 'pbkdf2_sha256' or int(parts[1]) != iterations
+
+
+class UserStore:
+    """In-memory user index with salted password hashing and short-lived sessions.
+
+    users.xlsx is read into a dict keyed by username and re-read only when
+    the file changes. Logging in runs the slow KDF once and opens a session
+    holding an HMAC of the password under a random session key, so unlocking
+    the terminal before the session expires is a keyed-hash check instead of
+    another KDF run. Legacy unsalted hashes are upgraded on successful login.
+    """
+
+    def __init__(self, path='users.xlsx', iterations=PASSWORD_HASH_ITERATIONS, session_minutes=SESSION_MINUTES):
+        self.path = path
+        self.iterations = iterations
+        self.session_lifetime = session_minutes * 60
+        self.users = {}
+        self.version = None
+        self.sessions = {}
+
+        # Checked for unknown usernames so they take as long to reject as wrong passwords
+        self._dummy_hash = hash_password('', iterations)
+
+    def reload(self):
+        """Rebuild the username index if users.xlsx changed"""
+        stat = os.stat(self.path)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if version != self.version:
+            users_df = pd.read_excel(self.path, dtype={'Username': str, 'Password': str})
+            self.users = {username: {'username': username, 'password': password, 'role': role}
+                          for username, password, role in zip(users_df['Username'], users_df['Password'],
+                                                              users_df['Role'])}
+            self.version = version
+
+    def login(self, username, password):
+        """Verify a password with the KDF and open a session; returns the session or None"""
+        self.reload()
+        user = self.users.get(username)
+        if not verify_password(password, user['password'] if user else self._dummy_hash) or user is None:
+            return None
+
+        if password_needs_rehash(user['password'], self.iterations):
+            self.set_password(username, password)
+            user = self.users[username]
+
+        key = os.urandom(32)
+        session = {
+            'username': username,
+            'role': user['role'],
+            'password_hash': user['password'],
+            'key': key,
+            'verifier': hmac.new(key, password.encode(), 'sha256').digest(),
+            'expires': time.monotonic() + self.session_lifetime,
+        }
+        self.sessions[username] = session
+        return session
+
+    def unlock(self, username, password):
+        """Resume an open session with a fast keyed-hash check.
+
+        Returns None if there is no session, it has expired, the user's
+        password changed since, or the password is wrong.
+        """
+        session = self.sessions.get(username)
+        if session is None:
+            return None
+        self.reload()
+        user = self.users.get(username)
+        if (time.monotonic() >= session['expires'] or user is None or
+                user['password'] != session['password_hash']):
+            del self.sessions[username]
+            return None
+        check = hmac.new(session['key'], password.encode(), 'sha256').digest()
+        if not hmac.compare_digest(check, session['verifier']):
+            return None
+        return session
+
+    def end_session(self, username):
+        self.sessions.pop(username, None)
+
+    def set_password(self, username, password):
+        """Store a new salted hash for a user"""
+        users_df = pd.read_excel(self.path, dtype={'Username': str, 'Password': str})
+        users_df.loc[users_df['Username'] == username, 'Password'] = hash_password(password, self.iterations)
+        write_excel_atomic(users_df, self.path)
+        self.reload()
+
 
 class InventoryManagementApp:
     def __init__(self, root):
@@ -21,8 +2110,59 @@ class InventoryManagementApp:
         # Initialize data files
         self.init_data_files()
         
-        # Current user
+        # Every sale is booked against this terminal's location, so a typo would strand them all
+        if TERMINAL_LOCATION not in LOCATIONS:
+            messagebox.showerror("Error", f"Unknown INVENTORY_LOCATION '{TERMINAL_LOCATION}'. "
+                                          f"Expected one of: {', '.join(LOCATIONS)}")
+            raise SystemExit(1)
+        
+        # Sales journal - replays any sales left over from a crash
+        self.sales_journal = SalesJournal('sales_journal.jsonl', apply_sales_batch)
+        try:
+            self.sales_journal.open(count_invoices)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to replay the sales journal: {str(e)}")
+            raise SystemExit(1)
+        self.journal_error_shown = False
+        # Another terminal or ingest.py may still be appending to a period being sealed
+        with self.sales_journal.store_lock:
+            seal_closed_invoice_periods()
+        self.root.after(500, self.poll_sales_journal)
+        
+        # Background incremental backups
+        self.backup_manager = BackupManager(self.sales_journal.store_lock)
+        
+        # Scheduled price changes - catch up on any that came due while closed
+        self.price_index_cache = None
+        try:
+            with self.sales_journal.store_lock:
+                apply_due_prices()
+        except Exception as e:
+            print(f"Error applying scheduled prices: {e}")
+        self.prices_checked_at = pd.Timestamp.now()
+        self.root.after(PRICE_CHECK_INTERVAL_SECONDS * 1000, self.apply_scheduled_prices)
+        
+        # Change bus - views apply deltas for the keys each mutation touched
+        self.products_cache = None
+        self.change_bus = ChangeBus(self.root)
+        product_events = (PRODUCT_ADDED, PRODUCT_UPDATED, PRODUCT_DELETED, STOCK_CHANGED)
+        self.change_bus.subscribe(product_events, self.on_products_changed)
+        self.change_bus.subscribe(product_events, self.on_stock_changed)
+        self.change_bus.subscribe(product_events, self.on_billing_products_changed)
+        self.change_bus.subscribe((PRODUCT_ADDED, PRODUCT_UPDATED, PRODUCT_DELETED), self.on_catalog_changed)
+        
+        # Shared type-ahead index for the SKU pickers
+        self.sku_prefix_index = PrefixIndex()
+        self.change_bus.subscribe((INVOICE_CREATED,), self.on_invoices_created)
+        
+        # Current user - sessions let cashiers lock and unlock the terminal without logging out
         self.current_user = None
+        self.user_store = UserStore()
+        self.lock_window = None
+        self.last_activity = time.monotonic()
+        self.root.bind_all('<Any-KeyPress>', self.note_activity, add='+')
+        self.root.bind_all('<Any-ButtonPress>', self.note_activity, add='+')
+        self.root.after(30000, self.check_idle)
         
         # Show login screen
         self.show_login()
@@ -34,18 +2174,31 @@ class InventoryManagementApp:
             df = pd.DataFrame(columns=['SKU', 'Product_Name', 'Category', 'Price', 'Cost', 'Quantity', 'Supplier', 'Min_Stock'])
             df.to_excel('products.xlsx', index=False)
         
-        # Invoices file
-        if not os.path.exists('invoices.xlsx'):
-            df = pd.DataFrame(columns=['Invoice_ID', 'Date', 'Customer_Name', 'Items', 'Total_Amount', 'Payment_Type'])
-            df.to_excel('invoices.xlsx', index=False)
+        # Invoice partitions - a single legacy invoices.xlsx is split by period
+        if not os.path.isdir(INVOICE_DIR):
+            migrate_legacy_invoices()
+        
+        # Lot partitions - a single legacy lots.xlsx is split by location
+        migrate_legacy_lots()
         
         # Users file
         if not os.path.exists('users.xlsx'):
             # Create default admin user
-            password_hash = hashlib.sha256('admin123'.encode()).hexdigest()
+            password_hash = hash_password('admin123')
             df = pd.DataFrame([['admin', password_hash, 'Admin']], columns=['Username', 'Password', 'Role'])
             df.to_excel('users.xlsx', index=False)
         
+        # Stock partitions - existing stock starts at the first location
+        if not os.path.exists('stock'):
+            os.makedirs('stock')
+            products_df = pd.read_excel('products.xlsx')
+            for location in LOCATIONS:
+                if location == LOCATIONS[0]:
+                    quantities = products_df.set_index(products_df['SKU'].astype(str))['Quantity']
+                else:
+                    quantities = pd.Series(dtype='int64')
+                write_location_stock(location, quantities)
+        
         # Create folders for images and barcodes
         os.makedirs('images', exist_ok=True)
         os.makedirs('barcodes', exist_ok=True)
@@ -53,6 +2206,7 @@ class InventoryManagementApp:
     def show_login(self):
         """Display login screen"""
         self.clear_screen()
+        self.current_user = None
         
         login_frame = tk.Frame(self.root, bg='white', padx=50, pady=50)
         login_frame.place(relx=0.5, rely=0.5, anchor='center')
@@ -83,19 +2237,108 @@ class InventoryManagementApp:
             return
         
         try:
-            users_df = pd.read_excel('users.xlsx')
-            password_hash = hashlib.sha256(password.encode()).hexdigest()
+            session = self.user_store.login(username, password)
             
-            user = users_df[(users_df['Username'] == username) & (users_df['Password'] == password_hash)]
-            
-            if not user.empty:
-                self.current_user = {'username': username, 'role': user.iloc[0]['Role']}
+            if session is not None:
+                self.current_user = {'username': username, 'role': session['role']}
+                self.root.unbind('<Return>')
                 self.show_main_interface()
             else:
                 messagebox.showerror("Error", "Invalid username or password")
         except Exception as e:
             messagebox.showerror("Error", f"Login failed: {str(e)}")
     
+    def logout(self):
+        """End the current user's session and return to the login screen"""
+        self.user_store.end_session(self.current_user['username'])
+        # clear_screen destroys the lock window along with everything else
+        self.root.unbind('<Configure>')
+        self.lock_window = None
+        self.show_login()
+    
+    def note_activity(self, event):
+        self.last_activity = time.monotonic()
+    
+    def check_idle(self):
+        """Lock the terminal after TERMINAL_LOCK_MINUTES without input"""
+        idle = time.monotonic() - self.last_activity
+        if self.current_user is not None and self.lock_window is None and idle >= TERMINAL_LOCK_MINUTES * 60:
+            self.lock_terminal()
+        self.root.after(30000, self.check_idle)
+    
+    def lock_terminal(self):
+        """Cover the main interface with a modal unlock prompt; tabs stay built underneath"""
+        if self.lock_window is not None:
+            return
+        
+        # Close dialogs and report windows so nothing stays usable or visible behind the lock
+        for widget in self.root.winfo_children():
+            if isinstance(widget, tk.Toplevel):
+                widget.destroy()
+        
+        self.lock_window = tk.Toplevel(self.root, bg='#263238')
+        self.lock_window.title("Terminal Locked")
+        self.lock_window.transient(self.root)
+        self.lock_window.protocol("WM_DELETE_WINDOW", lambda: None)
+        self.cover_root()
+        self.root.bind('<Configure>', lambda e: self.cover_root() if e.widget is self.root else None)
+        
+        # The grab confines mouse and keyboard input, including Tab traversal, to the lock window
+        self.lock_window.grab_set()
+        
+        prompt_frame = tk.Frame(self.lock_window, bg='white', padx=40, pady=30)
+        prompt_frame.place(relx=0.5, rely=0.5, anchor='center')
+        
+        tk.Label(prompt_frame, text="Terminal Locked", font=('Arial', 20, 'bold'), bg='white').pack(pady=10)
+        
+        tk.Label(prompt_frame, text="Username:", font=('Arial', 12), bg='white').pack(pady=5)
+        username_entry = tk.Entry(prompt_frame, font=('Arial', 12), width=20)
+        username_entry.insert(0, self.current_user['username'])
+        username_entry.pack(pady=5)
+        
+        tk.Label(prompt_frame, text="Password:", font=('Arial', 12), bg='white').pack(pady=5)
+        password_entry = tk.Entry(prompt_frame, font=('Arial', 12), width=20, show='*')
+        password_entry.pack(pady=5)
+        password_entry.focus_set()
+        
+        unlock = lambda: self.unlock_terminal(username_entry.get(), password_entry)
+        tk.Button(prompt_frame, text="Unlock", command=unlock, bg='#4CAF50', fg='white', 
+                 font=('Arial', 12), width=15).pack(pady=15)
+        password_entry.bind('<Return>', lambda e: unlock())
+        
+        tk.Button(prompt_frame, text="Logout", command=self.logout, bg='#f44336', fg='white', 
+                 font=('Arial', 10)).pack()
+    
+    def cover_root(self):
+        """Place the lock window exactly over the main window"""
+        if self.lock_window is None or not self.lock_window.winfo_exists():
+            return
+        self.lock_window.geometry(f"{self.root.winfo_width()}x{self.root.winfo_height()}"
+                                  f"+{self.root.winfo_rootx()}+{self.root.winfo_rooty()}")
+    
+    def unlock_terminal(self, username, password_entry):
+        """Unlock for the same or another cashier without rebuilding the tabs"""
+        password = password_entry.get()
+        password_entry.delete(0, tk.END)
+        
+        try:
+            # An open session verifies instantly; otherwise fall back to a full login
+            session = self.user_store.unlock(username, password) or self.user_store.login(username, password)
+        except Exception as e:
+            messagebox.showerror("Error", f"Unlock failed: {str(e)}")
+            return
+        if session is None:
+            messagebox.showerror("Error", "Invalid username or password")
+            return
+        
+        self.current_user = {'username': username, 'role': session['role']}
+        self.title_label.config(text=f"Inventory Management System - Welcome {username}")
+        self.root.unbind('<Configure>')
+        self.lock_window.grab_release()
+        self.lock_window.destroy()
+        self.lock_window = None
+        self.last_activity = time.monotonic()
+    
     def show_main_interface(self):
         """Display main application interface"""
         self.clear_screen()
@@ -109,17 +2352,32 @@ class InventoryManagementApp:
         title_frame.pack(fill='x')
         title_frame.pack_propagate(False)
         
-        tk.Label(title_frame, text=f"Inventory Management System - Welcome {self.current_user['username']}", 
-                font=('Arial', 18, 'bold'), bg='#2196F3', fg='white').pack(pady=15)
+        self.title_label = tk.Label(title_frame, text=f"Inventory Management System - Welcome {self.current_user['username']}", 
+                                    font=('Arial', 18, 'bold'), bg='#2196F3', fg='white')
+        self.title_label.pack(pady=15)
         
         # Logout button
-        tk.Button(title_frame, text="Logout", command=self.show_login, bg='#f44336', fg='white',
+        tk.Button(title_frame, text="Logout", command=self.logout, bg='#f44336', fg='white',
                  font=('Arial', 10)).place(relx=0.95, rely=0.5, anchor='center')
         
+        # Lock button - hands the terminal to another cashier without logging out
+        tk.Button(title_frame, text="Lock", command=self.lock_terminal, bg='#FF9800', fg='white',
+                 font=('Arial', 10)).place(relx=0.82, rely=0.5, anchor='center')
+        
+        # Backups button
+        tk.Button(title_frame, text="Backups", command=self.show_backups, bg='#607D8B', fg='white',
+                 font=('Arial', 10)).place(relx=0.88, rely=0.5, anchor='center')
+        
         # Create notebook for tabs
         self.notebook = ttk.Notebook(main_frame)
         self.notebook.pack(fill='both', expand=True, padx=10, pady=10)
         
+        # Build the SKU picker index once for all tabs
+        try:
+            self.sku_prefix_index.build(self.read_products())
+        except Exception as e:
+            print(f"Error building SKU index: {e}")
+        
         # Create tabs
         self.create_dashboard_tab()
         self.create_products_tab()
@@ -138,13 +2396,12 @@ class InventoryManagementApp:
         stats_frame.pack(fill='x', padx=10, pady=10)
         
         try:
-            products_df = pd.read_excel('products.xlsx')
-            invoices_df = pd.read_excel('invoices.xlsx')
+            products_df = with_stock_totals(pd.read_excel('products.xlsx'))
             
             total_products = len(products_df)
             total_stock = products_df['Quantity'].sum() if not products_df.empty else 0
             low_stock_items = len(products_df[products_df['Quantity'] <= products_df['Min_Stock']]) if not products_df.empty else 0
-            total_invoices = len(invoices_df)
+            total_invoices = count_invoices()
             
             # Create statistics display
             stats_data = [
@@ -176,6 +2433,21 @@ class InventoryManagementApp:
                 for _, row in low_stock_df.iterrows():
                     tk.Label(alert_frame, text=f"{row['Product_Name']} - Only {row['Quantity']} left", 
                             font=('Arial', 10), bg='#ffebee', fg='#d32f2f').pack()
+            
+            # Expiry alerts
+            expiring_df = expiring_lots(EXPIRY_ALERT_DAYS)
+            if not expiring_df.empty:
+                expiry_frame = tk.Frame(dashboard_frame, bg='#fff3e0', relief='raised', bd=2)
+                expiry_frame.pack(fill='x', padx=10, pady=10)
+                
+                tk.Label(expiry_frame, text=f"Lots Expiring Within {EXPIRY_ALERT_DAYS} Days", 
+                        font=('Arial', 14, 'bold'), bg='#fff3e0', fg='#e65100').pack(pady=5)
+                
+                for row in expiring_df.itertuples(index=False):
+                    when = "expired" if row.Days_Left < 0 else f"{row.Days_Left} days left"
+                    tk.Label(expiry_frame, text=f"SKU {row.SKU} lot {row.Lot} at {row.Location} - "
+                             f"{int(row.Quantity)} units, {when}", 
+                            font=('Arial', 10), bg='#fff3e0', fg='#e65100').pack()
         
         except Exception as e:
             tk.Label(dashboard_frame, text=f"Error loading dashboard: {str(e)}", 
@@ -217,6 +2489,10 @@ class InventoryManagementApp:
                  bg='#f44336', fg='white').pack(side='left', padx=5)
         tk.Button(button_frame, text="Clear Fields", command=self.clear_product_fields, 
                  bg='#FF9800', fg='white').pack(side='left', padx=5)
+        tk.Button(button_frame, text="Find Duplicates", command=self.find_duplicates, 
+                 bg='#9C27B0', fg='white').pack(side='left', padx=5)
+        tk.Button(button_frame, text="Price History", command=self.show_price_history, 
+                 bg='#607D8B', fg='white').pack(side='left', padx=5)
         
         # Products list
         list_frame = tk.Frame(products_frame)
@@ -258,15 +2534,20 @@ class InventoryManagementApp:
         
         # SKU selection
         tk.Label(form_frame, text="Select Product (SKU):", bg='white').pack()
-        self.stock_sku_var = tk.StringVar()
-        self.stock_sku_combo = ttk.Combobox(form_frame, textvariable=self.stock_sku_var, width=30)
-        self.stock_sku_combo.pack(pady=5)
+        self.stock_sku_picker = SkuPicker(form_frame, self.sku_prefix_index, bg='white')
+        self.stock_sku_picker.pack(pady=5)
         
         # Quantity adjustment
         tk.Label(form_frame, text="Quantity Change (+ for stock in, - for stock out):", bg='white').pack()
         self.stock_qty_entry = tk.Entry(form_frame, width=20)
         self.stock_qty_entry.pack(pady=5)
         
+        # Location
+        tk.Label(form_frame, text="Location:", bg='white').pack()
+        self.stock_location_var = tk.StringVar(value=TERMINAL_LOCATION)
+        ttk.Combobox(form_frame, textvariable=self.stock_location_var, values=LOCATIONS,
+                     state='readonly', width=20).pack(pady=5)
+        
         # Reason
         tk.Label(form_frame, text="Reason:", bg='white').pack()
         self.stock_reason_entry = tk.Entry(form_frame, width=40)
@@ -281,6 +2562,58 @@ class InventoryManagementApp:
         tk.Button(button_frame, text="Stock Out", command=lambda: self.adjust_stock('out'), 
                  bg='#f44336', fg='white').pack(side='left', padx=5)
         
+        # Transfer between locations
+        transfer_frame = tk.Frame(form_frame, bg='white')
+        transfer_frame.pack(pady=10)
+        
+        tk.Label(transfer_frame, text="Transfer from:", bg='white').pack(side='left')
+        self.transfer_from_var = tk.StringVar(value=LOCATIONS[-1])
+        ttk.Combobox(transfer_frame, textvariable=self.transfer_from_var, values=LOCATIONS,
+                     state='readonly', width=12).pack(side='left', padx=5)
+        tk.Label(transfer_frame, text="to:", bg='white').pack(side='left')
+        self.transfer_to_var = tk.StringVar(value=TERMINAL_LOCATION)
+        ttk.Combobox(transfer_frame, textvariable=self.transfer_to_var, values=LOCATIONS,
+                     state='readonly', width=12).pack(side='left', padx=5)
+        tk.Label(transfer_frame, text="Qty:", bg='white').pack(side='left')
+        self.transfer_qty_entry = tk.Entry(transfer_frame, width=8)
+        self.transfer_qty_entry.pack(side='left', padx=5)
+        tk.Button(transfer_frame, text="Transfer", command=self.transfer_stock, 
+                 bg='#2196F3', fg='white').pack(side='left', padx=5)
+        
+        # Lot receiving for perishables
+        lot_frame = tk.Frame(form_frame, bg='white')
+        lot_frame.pack(pady=10)
+        
+        tk.Label(lot_frame, text="Lot:", bg='white').pack(side='left')
+        self.lot_entry = tk.Entry(lot_frame, width=12)
+        self.lot_entry.pack(side='left', padx=5)
+        tk.Label(lot_frame, text="Expiry (YYYY-MM-DD):", bg='white').pack(side='left')
+        self.lot_expiry_entry = tk.Entry(lot_frame, width=12)
+        self.lot_expiry_entry.pack(side='left', padx=5)
+        tk.Button(lot_frame, text="Receive Lot", command=self.receive_lot, 
+                 bg='#4CAF50', fg='white').pack(side='left', padx=5)
+        tk.Button(lot_frame, text="Expiring Lots...", command=self.show_expiring_lots, 
+                 bg='#FF9800', fg='white').pack(side='left', padx=5)
+        
+        # Stocktake / cycle count at the selected location
+        stocktake_frame = tk.Frame(form_frame, bg='white')
+        stocktake_frame.pack(pady=10)
+        
+        self.stocktake_session = None
+        self.full_count_var = tk.BooleanVar(value=True)
+        tk.Checkbutton(stocktake_frame, text="Full count", variable=self.full_count_var, 
+                       bg='white').pack(side='left')
+        tk.Button(stocktake_frame, text="Start Stocktake", command=self.start_stocktake, 
+                 bg='#9C27B0', fg='white').pack(side='left', padx=5)
+        tk.Label(stocktake_frame, text="Count scan:", bg='white').pack(side='left')
+        self.stocktake_scan_entry = tk.Entry(stocktake_frame, width=20, state='disabled')
+        self.stocktake_scan_entry.pack(side='left', padx=5)
+        self.stocktake_scan_entry.bind('<Return>', self.on_stocktake_scan)
+        tk.Button(stocktake_frame, text="Reconcile", command=self.reconcile_stocktake, 
+                 bg='#FF9800', fg='white').pack(side='left', padx=5)
+        self.stocktake_status_label = tk.Label(stocktake_frame, text="", bg='white')
+        self.stocktake_status_label.pack(side='left', padx=5)
+        
         # Stock history (simplified)
         history_frame = tk.Frame(stock_frame)
         history_frame.pack(fill='both', expand=True, padx=10, pady=10)
@@ -288,7 +2621,7 @@ class InventoryManagementApp:
         tk.Label(history_frame, text="Current Stock Levels", font=('Arial', 14, 'bold')).pack()
         
         # Stock tree
-        stock_columns = ('SKU', 'Product Name', 'Current Stock', 'Min Stock', 'Status')
+        stock_columns = ('SKU', 'Product Name', *LOCATIONS, 'Current Stock', 'Min Stock', 'Status')
         self.stock_tree = ttk.Treeview(history_frame, columns=stock_columns, show='headings', height=15)
         
         for col in stock_columns:
@@ -299,7 +2632,6 @@ class InventoryManagementApp:
         
         # Load stock data
         self.load_stock_data()
-        self.update_stock_combo()
     
     def create_billing_tab(self):
         """Create billing/POS tab"""
@@ -317,6 +2649,20 @@ class InventoryManagementApp:
         # Left side - Product selection
         tk.Label(left_frame, text="Product Selection", font=('Arial', 14, 'bold'), bg='white').pack(pady=10)
         
+        # Barcode scanner input (keyboard wedge)
+        scan_frame = tk.Frame(left_frame, bg='white')
+        scan_frame.pack(fill='x', padx=10, pady=5)
+        
+        tk.Label(scan_frame, text="Scan Barcode:", bg='white').pack(side='left')
+        self.scan_entry = tk.Entry(scan_frame, width=30)
+        self.scan_entry.pack(side='left', padx=5)
+        self.scan_status_label = tk.Label(scan_frame, text="", bg='white', fg='#4CAF50')
+        self.scan_status_label.pack(side='left', padx=5)
+        
+        self.scan_key_times = []
+        self.scan_entry.bind('<Key>', self.on_scan_key)
+        self.scan_entry.bind('<Return>', self.on_scan_enter)
+        
         # Search product
         search_frame = tk.Frame(left_frame, bg='white')
         search_frame.pack(fill='x', padx=10, pady=5)
@@ -392,10 +2738,15 @@ class InventoryManagementApp:
         
         # Initialize cart
         self.cart_items = []
+        self.cart_rows = {}
         self.cart_total = 0.0
         
+        # SKU -> product lookup for scanned barcodes
+        self.sku_index = {}
+        
         # Load products for billing
         self.load_billing_products()
+        self.scan_entry.focus_set()
     
     def create_invoices_tab(self):
         """Create invoices management tab"""
@@ -414,6 +2765,7 @@ class InventoryManagementApp:
         self.invoice_search_entry.pack(side='left', padx=5)
         tk.Button(search_frame, text="Search", command=self.search_invoices).pack(side='left', padx=5)
         tk.Button(search_frame, text="Show All", command=self.load_invoices).pack(side='left', padx=5)
+        tk.Button(search_frame, text="Export...", command=self.show_export_dialog).pack(side='left', padx=5)
         
         # Invoice tree
         invoice_columns = ('Invoice ID', 'Date', 'Customer', 'Total Amount', 'Payment Type')
@@ -441,9 +2793,8 @@ class InventoryManagementApp:
         
         # SKU selection
         tk.Label(form_frame, text="Select Product SKU:", bg='white').pack()
-        self.barcode_sku_var = tk.StringVar()
-        self.barcode_sku_combo = ttk.Combobox(form_frame, textvariable=self.barcode_sku_var, width=30)
-        self.barcode_sku_combo.pack(pady=5)
+        self.barcode_sku_picker = SkuPicker(form_frame, self.sku_prefix_index, bg='white')
+        self.barcode_sku_picker.pack(pady=5)
         
         # Buttons
         button_frame = tk.Frame(form_frame, bg='white')
@@ -457,9 +2808,6 @@ class InventoryManagementApp:
         # Barcode display area
         self.barcode_display_frame = tk.Frame(barcode_frame, bg='white', relief='raised', bd=2)
         self.barcode_display_frame.pack(fill='both', expand=True, padx=10, pady=10)
-        
-        # Update barcode combo
-        self.update_barcode_combo()
     
     def clear_screen(self):
         """Clear all widgets from the screen"""
@@ -482,35 +2830,34 @@ class InventoryManagementApp:
                 messagebox.showerror("Error", "SKU and Product Name are required")
                 return
             
-            # Load existing products
-            products_df = pd.read_excel('products.xlsx')
-            
-            # Check for duplicate SKU
-            if product_data['sku'] in products_df['SKU'].values:
-                messagebox.showerror("Error", "SKU already exists")
-                return
-            
-            # Add new product
-            new_product = pd.DataFrame([{
-                'SKU': product_data['sku'],
-                'Product_Name': product_data['product_name'],
-                'Category': product_data['category'],
-                'Price': product_data['price'],
-                'Cost': product_data['cost'],
-                'Quantity': product_data['quantity'],
-                'Supplier': product_data['supplier'],
-                'Min_Stock': product_data['min_stock']
-            }])
-            
-            products_df = pd.concat([products_df, new_product], ignore_index=True)
-            products_df.to_excel('products.xlsx', index=False)
+            with self.sales_journal.store_lock:
+                # Load existing products
+                products_df = pd.read_excel('products.xlsx')
+                
+                # Check for duplicate SKU
+                if product_data['sku'] in products_df['SKU'].astype(str).values:
+                    messagebox.showerror("Error", "SKU already exists")
+                    return
+                
+                # Add new product with no stock, then book the opening quantity at this terminal's location
+                new_product = pd.DataFrame([{
+                    'SKU': product_data['sku'],
+                    'Product_Name': product_data['product_name'],
+                    'Category': product_data['category'],
+                    'Price': product_data['price'],
+                    'Cost': product_data['cost'],
+                    'Quantity': 0,
+                    'Supplier': product_data['supplier'],
+                    'Min_Stock': product_data['min_stock']
+                }])
+                
+                products_df = pd.concat([products_df, new_product], ignore_index=True)
+                write_excel_atomic(products_df, 'products.xlsx')
+                apply_stock_changes([(product_data['sku'], TERMINAL_LOCATION, product_data['quantity'])])
             
             messagebox.showinfo("Success", "Product added successfully")
             self.clear_product_fields()
-            self.load_products()
-            self.update_stock_combo()
-            self.update_barcode_combo()
-            self.load_billing_products()
+            self.change_bus.publish(PRODUCT_ADDED, [product_data['sku']])
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to add product: {str(e)}")
@@ -535,24 +2882,32 @@ class InventoryManagementApp:
                     value = float(value) if value else 0
                 product_data[field] = value
             
-            # Load and update products
-            products_df = pd.read_excel('products.xlsx')
-            idx = products_df[products_df['SKU'] == sku].index[0]
-            
-            products_df.loc[idx, 'Product_Name'] = product_data['product_name']
-            products_df.loc[idx, 'Category'] = product_data['category']
-            products_df.loc[idx, 'Price'] = product_data['price']
-            products_df.loc[idx, 'Cost'] = product_data['cost']
-            products_df.loc[idx, 'Quantity'] = product_data['quantity']
-            products_df.loc[idx, 'Supplier'] = product_data['supplier']
-            products_df.loc[idx, 'Min_Stock'] = product_data['min_stock']
-            
-            products_df.to_excel('products.xlsx', index=False)
+            with self.sales_journal.store_lock:
+                # Quantity edits are booked as a change at this terminal's location
+                products_df = with_stock_totals(pd.read_excel('products.xlsx'))
+                idx = products_df[products_df['SKU'].astype(str) == str(sku)].index[0]
+                qty_change = product_data['quantity'] - products_df.loc[idx, 'Quantity']
+                if qty_change:
+                    apply_stock_changes([(sku, TERMINAL_LOCATION, qty_change)])
+                
+                # Load and update products
+                products_df = pd.read_excel('products.xlsx')
+                
+                products_df.loc[idx, 'Product_Name'] = product_data['product_name']
+                products_df.loc[idx, 'Category'] = product_data['category']
+                products_df.loc[idx, 'Supplier'] = product_data['supplier']
+                products_df.loc[idx, 'Min_Stock'] = product_data['min_stock']
+                price_changed = (products_df.loc[idx, 'Price'] != product_data['price'] or
+                                 products_df.loc[idx, 'Cost'] != product_data['cost'])
+                
+                write_excel_atomic(products_df, 'products.xlsx')
+                
+                # Price and cost changes are kept in the price history instead of overwritten
+                if price_changed:
+                    schedule_price(sku, product_data['price'], product_data['cost'])
             
             messagebox.showinfo("Success", "Product updated successfully")
-            self.load_products()
-            self.load_stock_data()
-            self.load_billing_products()
+            self.change_bus.publish(PRODUCT_UPDATED, [sku])
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to update product: {str(e)}")
@@ -570,21 +2925,116 @@ class InventoryManagementApp:
                 item = self.products_tree.item(selected[0])
                 sku = item['values'][0]
                 
-                # Load and update products
-                products_df = pd.read_excel('products.xlsx')
-                products_df = products_df[products_df['SKU'] != sku]
-                products_df.to_excel('products.xlsx', index=False)
+                with self.sales_journal.store_lock:
+                    # Apply pending sales while the SKU still exists
+                    self.sales_journal.flush()
+                    
+                    # Load and update products
+                    products_df = pd.read_excel('products.xlsx')
+                    products_df = products_df[products_df['SKU'].astype(str) != str(sku)]
+                    write_excel_atomic(products_df, 'products.xlsx')
+                    
+                    # Drop the SKU from every location partition
+                    for location in LOCATIONS:
+                        quantities = read_location_stock(location)
+                        write_location_stock(location, quantities.drop(str(sku), errors='ignore'))
                 
                 messagebox.showinfo("Success", "Product deleted successfully")
                 self.clear_product_fields()
-                self.load_products()
-                self.update_stock_combo()
-                self.update_barcode_combo()
-                self.load_billing_products()
+                self.change_bus.publish(PRODUCT_DELETED, [sku])
                 
             except Exception as e:
                 messagebox.showerror("Error", f"Failed to delete product: {str(e)}")
     
+    def find_duplicates(self):
+        """Run duplicate detection off the UI thread, then open the review screen"""
+        results = queue.Queue()
+        
+        def worker():
+            try:
+                results.put(('done', find_duplicate_products(pd.read_excel('products.xlsx'))))
+            except Exception as e:
+                results.put(('error', str(e)))
+        
+        def poll():
+            try:
+                kind, value = results.get_nowait()
+            except queue.Empty:
+                self.root.after(100, poll)
+                return
+            if kind == 'error':
+                messagebox.showerror("Error", f"Duplicate detection failed: {value}")
+            elif value.empty:
+                messagebox.showinfo("Duplicates", "No likely duplicates found")
+            else:
+                self.show_duplicate_review(value)
+        
+        threading.Thread(target=worker, name='duplicates', daemon=True).start()
+        poll()
+    
+    def show_duplicate_review(self, pairs):
+        """Review candidate duplicate pairs and merge the ones that are real"""
+        review_window = tk.Toplevel(self.root)
+        review_window.title("Duplicate Products")
+        review_window.geometry("900x450")
+        review_window.transient(self.root)
+        
+        tk.Label(review_window, text=f"{len(pairs)} candidate duplicate pairs", 
+                font=('Arial', 12, 'bold')).pack(pady=10)
+        
+        columns = ('SKU A', 'Name A', 'Supplier A', 'SKU B', 'Name B', 'Supplier B', 'Similarity')
+        pairs_tree = ttk.Treeview(review_window, columns=columns, show='headings', height=15)
+        for col in columns:
+            pairs_tree.heading(col, text=col)
+            pairs_tree.column(col, width=120)
+        for i, row in enumerate(pairs.itertuples(index=False)):
+            pairs_tree.insert('', 'end', iid=str(i), values=(
+                row.SKU_A, row.Name_A, row.Supplier_A, row.SKU_B, row.Name_B, row.Supplier_B,
+                f"{row.Similarity:.0%}"
+            ))
+        pairs_tree.pack(fill='both', expand=True, padx=10, pady=5)
+        
+        def merge(keep_first):
+            selected = pairs_tree.selection()
+            if not selected:
+                messagebox.showerror("Error", "Please select a pair", parent=review_window)
+                return
+            pair = pairs.iloc[int(selected[0])]
+            keep_sku, drop_sku = (pair['SKU_A'], pair['SKU_B']) if keep_first else (pair['SKU_B'], pair['SKU_A'])
+            if not messagebox.askyesno("Confirm", f"Merge SKU {drop_sku} into {keep_sku}? "
+                                       f"SKU {drop_sku} will be deleted.", parent=review_window):
+                return
+            
+            try:
+                with self.sales_journal.store_lock:
+                    # Apply pending sales of the dropped SKU before it disappears
+                    self.sales_journal.flush()
+                    merge_products(keep_sku, drop_sku)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to merge products: {str(e)}", parent=review_window)
+                return
+            
+            # Pairs involving the deleted SKU are no longer valid
+            for iid in pairs_tree.get_children():
+                row = pairs.iloc[int(iid)]
+                if drop_sku in (row['SKU_A'], row['SKU_B']):
+                    pairs_tree.delete(iid)
+            self.change_bus.publish(PRODUCT_DELETED, [drop_sku])
+            self.change_bus.publish(STOCK_CHANGED, [keep_sku])
+        
+        def dismiss():
+            for iid in pairs_tree.selection():
+                pairs_tree.delete(iid)
+        
+        button_frame = tk.Frame(review_window)
+        button_frame.pack(pady=10)
+        tk.Button(button_frame, text="Keep A, Merge B into A", command=lambda: merge(True), 
+                 bg='#4CAF50', fg='white').pack(side='left', padx=5)
+        tk.Button(button_frame, text="Keep B, Merge A into B", command=lambda: merge(False), 
+                 bg='#2196F3', fg='white').pack(side='left', padx=5)
+        tk.Button(button_frame, text="Not a Duplicate", command=dismiss, 
+                 bg='#FF9800', fg='white').pack(side='left', padx=5)
+    
     def clear_product_fields(self):
         """Clear all product form fields"""
         for entry in self.product_entries.values():
@@ -607,7 +3057,7 @@ class InventoryManagementApp:
     def load_products(self):
         """Load products into the tree view"""
         try:
-            products_df = pd.read_excel('products.xlsx')
+            products_df = with_stock_totals(pd.read_excel('products.xlsx'))
             
             # Clear existing items
             for item in self.products_tree.get_children():
@@ -615,18 +3065,25 @@ class InventoryManagementApp:
             
             # Add products to tree
             for _, row in products_df.iterrows():
-                self.products_tree.insert('', 'end', values=(
-                    row['SKU'], row['Product_Name'], row['Category'], 
-                    f"${row['Price']:.2f}", f"${row['Cost']:.2f}", 
-                    int(row['Quantity']), row['Supplier']
-                ))
+                self.products_tree.insert('', 'end', iid=str(row['SKU']), values=self.product_row_values(row))
         except Exception as e:
             print(f"Error loading products: {e}")
     
+    def product_row_values(self, row):
+        """Format a product row for the products tree"""
+        return (
+            row['SKU'], row['Product_Name'], row['Category'], 
+            f"${row['Price']:.2f}", f"${row['Cost']:.2f}", 
+            int(row['Quantity']), row['Supplier']
+        )
+    
     def adjust_stock(self, operation):
         """Adjust stock levels"""
         try:
-            sku = self.stock_sku_var.get().split(' - ')[0].strip()
+            sku = self.stock_sku_picker.get_sku()
+            if sku is None:
+                messagebox.showerror("Error", "Please select a product")
+                return
             qty_input = self.stock_qty_entry.get().strip()
 
             if not qty_input or qty_input in ['-', '+']:
@@ -644,40 +3101,260 @@ class InventoryManagementApp:
             else:
                 qty_change = abs(qty_change)
             
-            # Load products
-            products_df = pd.read_excel('products.xlsx')
-            
-            # Find product
-            product_idx = products_df[products_df['SKU'] == sku].index
-            if product_idx.empty:
-                messagebox.showerror("Error", "Product not found")
-                return
-            
-            # Update quantity
-            current_qty = products_df.loc[product_idx[0], 'Quantity']
-            new_qty = current_qty + qty_change
-            
-            if new_qty < 0:
-                messagebox.showerror("Error", "Insufficient stock")
-                return
+            location = self.stock_location_var.get()
             
-            products_df.loc[product_idx[0], 'Quantity'] = new_qty
-            products_df.to_excel('products.xlsx', index=False)
+            # Update the location partition and product total
+            with self.sales_journal.store_lock:
+                try:
+                    apply_stock_changes([(sku, location, qty_change)])
+                except ValueError as e:
+                    messagebox.showerror("Error", str(e))
+                    return
+                new_qty = int(read_location_stock(location).get(sku, 0))
             
-            messagebox.showinfo("Success", f"Stock updated. New quantity: {new_qty}")
+            messagebox.showinfo("Success", f"Stock updated. New quantity at {location}: {new_qty}")
             
             # Clear fields
             self.stock_qty_entry.delete(0, tk.END)
             self.stock_reason_entry.delete(0, tk.END)
             
             # Refresh displays
-            self.load_stock_data()
-            self.load_products()
-            self.load_billing_products()
+            self.change_bus.publish(STOCK_CHANGED, [sku])
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to adjust stock: {str(e)}")
     
+    def transfer_stock(self):
+        """Move stock of the selected product between two locations"""
+        try:
+            sku = self.stock_sku_picker.get_sku()
+            if sku is None:
+                messagebox.showerror("Error", "Please select a product")
+                return
+            source = self.transfer_from_var.get()
+            target = self.transfer_to_var.get()
+            
+            try:
+                qty = int(self.transfer_qty_entry.get().strip())
+            except ValueError:
+                messagebox.showerror("Error", "Quantity must be a valid integer.")
+                return
+            
+            if qty <= 0:
+                messagebox.showerror("Error", "Quantity must be positive")
+                return
+            if source == target:
+                messagebox.showerror("Error", "Choose two different locations")
+                return
+            
+            with self.sales_journal.store_lock:
+                try:
+                    allocations = apply_stock_changes([(sku, source, -qty), (sku, target, qty)])
+                except ValueError as e:
+                    messagebox.showerror("Error", str(e))
+                    return
+                
+                # Lots drawn from the source move with the stock
+                moved = allocations[0]
+                if moved:
+                    receive_lots([(sku, lot, expiry, target, lot_qty) for lot, expiry, lot_qty in moved])
+            
+            messagebox.showinfo("Success", f"Transferred {qty} from {source} to {target}")
+            self.transfer_qty_entry.delete(0, tk.END)
+            
+            # Refresh displays
+            self.change_bus.publish(STOCK_CHANGED, [sku])
+            
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to transfer stock: {str(e)}")
+    
+    def receive_lot(self):
+        """Receive a lot with an expiry date into the selected location"""
+        sku = self.stock_sku_picker.get_sku()
+        if sku is None:
+            messagebox.showerror("Error", "Please select a product")
+            return
+        
+        lot = self.lot_entry.get().strip()
+        if not lot:
+            messagebox.showerror("Error", "Please enter a lot number")
+            return
+        
+        try:
+            expiry = pd.Timestamp(self.lot_expiry_entry.get().strip())
+        except ValueError:
+            messagebox.showerror("Error", "Expiry must be in YYYY-MM-DD format")
+            return
+        
+        try:
+            qty = int(self.stock_qty_entry.get().strip())
+        except ValueError:
+            messagebox.showerror("Error", "Quantity must be a valid integer.")
+            return
+        if qty <= 0:
+            messagebox.showerror("Error", "Quantity must be positive")
+            return
+        
+        location = self.stock_location_var.get()
+        try:
+            with self.sales_journal.store_lock:
+                receive_lot(sku, lot, expiry, location, qty)
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to receive lot: {str(e)}")
+            return
+        
+        messagebox.showinfo("Success", f"Received {qty} of lot {lot} at {location}")
+        self.stock_qty_entry.delete(0, tk.END)
+        self.lot_entry.delete(0, tk.END)
+        self.lot_expiry_entry.delete(0, tk.END)
+        self.change_bus.publish(STOCK_CHANGED, [sku])
+    
+    def show_expiring_lots(self):
+        """Show lots expiring within a number of days"""
+        report_window = tk.Toplevel(self.root)
+        report_window.title("Expiring Lots")
+        report_window.geometry("650x400")
+        report_window.transient(self.root)
+        
+        days_frame = tk.Frame(report_window)
+        days_frame.pack(pady=10)
+        tk.Label(days_frame, text="Expiring within (days):").pack(side='left')
+        days_entry = tk.Entry(days_frame, width=6)
+        days_entry.insert(0, str(EXPIRY_ALERT_DAYS))
+        days_entry.pack(side='left', padx=5)
+        
+        columns = ('SKU', 'Lot', 'Location', 'Expiry', 'Days Left', 'Quantity')
+        lots_tree = ttk.Treeview(report_window, columns=columns, show='headings', height=15)
+        for col in columns:
+            lots_tree.heading(col, text=col)
+            lots_tree.column(col, width=100)
+        lots_tree.pack(fill='both', expand=True, padx=10, pady=5)
+        
+        def refresh():
+            try:
+                days = int(days_entry.get())
+                lots_df = expiring_lots(days)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to load expiring lots: {str(e)}", parent=report_window)
+                return
+            for item in lots_tree.get_children():
+                lots_tree.delete(item)
+            for row in lots_df.itertuples(index=False):
+                lots_tree.insert('', 'end', values=(
+                    row.SKU, row.Lot, row.Location, row.Expiry.strftime('%Y-%m-%d'),
+                    row.Days_Left, int(row.Quantity)
+                ))
+        
+        tk.Button(days_frame, text="Show", command=refresh).pack(side='left', padx=5)
+        refresh()
+    
+    def start_stocktake(self):
+        """Freeze expected quantities at the selected location and start counting"""
+        location = self.stock_location_var.get()
+        if self.stocktake_session and not messagebox.askyesno(
+                "Confirm", "A stocktake is in progress. Discard it and start again?"):
+            return
+        
+        try:
+            self.stocktake_session = StocktakeSession(location, self.full_count_var.get())
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to start stocktake: {str(e)}")
+            return
+        
+        self.stocktake_scan_entry.config(state='normal')
+        self.stocktake_scan_entry.focus_set()
+        mode = "Full count" if self.stocktake_session.full_count else "Cycle count"
+        self.stocktake_status_label.config(text=f"{mode} at {location} - 0 units counted")
+    
+    def on_stocktake_scan(self, event):
+        """Count one unit per scan; 'SKU*N' counts N units"""
+        code = self.stocktake_scan_entry.get().strip()
+        self.stocktake_scan_entry.delete(0, tk.END)
+        if not code or self.stocktake_session is None:
+            return 'break'
+        
+        quantity = 1
+        if '*' in code:
+            code, _, qty_text = code.rpartition('*')
+            try:
+                quantity = int(qty_text)
+            except ValueError:
+                self.root.bell()
+                return 'break'
+            if quantity <= 0:
+                self.root.bell()
+                self.stocktake_status_label.config(text=f"Invalid quantity: {qty_text}")
+                return 'break'
+        
+        if code not in self.sku_prefix_index.names:
+            self.root.bell()
+            self.stocktake_status_label.config(text=f"Unknown SKU: {code}")
+            return 'break'
+        
+        counted = self.stocktake_session.record(code, quantity)
+        total = self.stocktake_session.total_counted
+        self.stocktake_status_label.config(text=f"{code}: {counted} - {total} units counted")
+        return 'break'
+    
+    def reconcile_stocktake(self):
+        """Show the variance report and post it as one batched adjustment"""
+        session = self.stocktake_session
+        if session is None:
+            messagebox.showerror("Error", "Start a stocktake first")
+            return
+        
+        try:
+            with self.sales_journal.store_lock:
+                # Acknowledged sales are gone from the shelf, so apply them before comparing
+                self.sales_journal.flush()
+                report = session.reconcile()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to reconcile stocktake: {str(e)}")
+            return
+        
+        variances = report[report['Variance'] != 0]
+        
+        report_window = tk.Toplevel(self.root)
+        report_window.title(f"Stocktake - {session.location}")
+        report_window.geometry("700x450")
+        report_window.transient(self.root)
+        
+        tk.Label(report_window, text=f"{len(report)} SKUs checked, {len(variances)} with variances, "
+                 f"net {int(variances['Variance'].sum()):+d} units").pack(pady=10)
+        
+        columns = ('SKU', 'Expected at Start', 'Movement', 'Expected', 'Counted', 'Variance')
+        variance_tree = ttk.Treeview(report_window, columns=columns, show='headings', height=15)
+        for col in columns:
+            variance_tree.heading(col, text=col)
+            variance_tree.column(col, width=100)
+        for row in variances.itertuples(index=False):
+            variance_tree.insert('', 'end', values=(
+                row.SKU, row.Expected_At_Start, row.Movement_During_Count,
+                row.Expected, row.Counted, f"{row.Variance:+d}"
+            ))
+        variance_tree.pack(fill='both', expand=True, padx=10, pady=5)
+        
+        def post():
+            try:
+                with self.sales_journal.store_lock:
+                    # Re-reconcile so sales made while the report was open are netted out
+                    self.sales_journal.flush()
+                    posted, path = session.post(session.reconcile())
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to post stocktake: {str(e)}", parent=report_window)
+                return
+            
+            messagebox.showinfo("Success", f"Posted {len(posted)} adjustments. Report saved as {path}",
+                                parent=report_window)
+            report_window.destroy()
+            self.stocktake_session = None
+            self.stocktake_scan_entry.config(state='disabled')
+            self.stocktake_status_label.config(text="")
+            self.change_bus.publish(STOCK_CHANGED, posted['SKU'])
+        
+        tk.Button(report_window, text="Post Adjustments", command=post, 
+                 bg='#4CAF50', fg='white').pack(pady=10)
+    
     def load_stock_data(self):
         """Load stock data into the tree view"""
         try:
@@ -688,36 +3365,139 @@ class InventoryManagementApp:
                 self.stock_tree.delete(item)
             
             # Add stock data to tree
-            for _, row in products_df.iterrows():
-                status = "Low Stock" if row['Quantity'] <= row['Min_Stock'] else "OK"
-                self.stock_tree.insert('', 'end', values=(
-                    row['SKU'], row['Product_Name'], int(row['Quantity']), 
-                    int(row['Min_Stock']), status
-                ))
-                
-                # Color code low stock items
-                if status == "Low Stock":
-                    item_id = self.stock_tree.get_children()[-1]
-                    self.stock_tree.set(item_id, 'Status', status)
+            for sku, values in self.stock_row_values(products_df).items():
+                self.stock_tree.insert('', 'end', iid=sku, values=values)
                     
         except Exception as e:
             print(f"Error loading stock data: {e}")
     
-    def update_stock_combo(self):
-        """Update stock SKU combo box"""
-        try:
-            products_df = pd.read_excel('products.xlsx')
-            sku_list = [f"{row['SKU']} - {row['Product_Name']}" for _, row in products_df.iterrows()]
-            self.stock_sku_combo['values'] = sku_list
-        except Exception as e:
-            print(f"Error updating stock combo: {e}")
+    def stock_row_values(self, products_df):
+        """Format stock tree rows for the given products, keyed by SKU"""
+        # SKU x location matrix and per-location low stock flags
+        skus = products_df['SKU'].astype(str)
+        stock = load_stock_matrix(keep_missing=True).reindex(index=skus, columns=LOCATIONS)
+        matrix = stock.fillna(0).astype('int64')
+        min_stock = products_df.set_index(skus)['Min_Stock']
+        low_flags = low_stock_by_location(matrix, min_stock, stocked=stock.notna())
+        low_locations = low_flags.apply(lambda row: ', '.join(row.index[row]), axis=1)
+        
+        rows = {}
+        for (_, row), sku, location_qty, low_at in zip(products_df.iterrows(), skus, matrix.values, low_locations):
+            total = int(location_qty.sum())
+            status = "Low Stock" if total <= row['Min_Stock'] else "OK"
+            if low_at:
+                status = f"{status} (low at {low_at})"
+            rows[sku] = (
+                row['SKU'], row['Product_Name'], *location_qty.tolist(), total, 
+                int(row['Min_Stock']), status
+            )
+        return rows
+    
+    def read_products(self):
+        """Read products.xlsx, reusing the previous read while the file is unchanged"""
+        stat = os.stat('products.xlsx')
+        version = (stat.st_mtime_ns, stat.st_size)
+        if self.products_cache is None or self.products_cache[0] != version:
+            self.products_cache = (version, pd.read_excel('products.xlsx'))
+        return self.products_cache[1].copy()
+    
+    def read_price_index(self):
+        """Price history interval index, rebuilt only when the history file changes"""
+        if not os.path.exists(PRICE_HISTORY_PATH):
+            return PriceIndex(pd.DataFrame(columns=PRICE_HISTORY_COLUMNS))
+        stat = os.stat(PRICE_HISTORY_PATH)
+        version = (stat.st_mtime_ns, stat.st_size)
+        if self.price_index_cache is None or self.price_index_cache[0] != version:
+            self.price_index_cache = (version, PriceIndex(read_price_history()))
+        return self.price_index_cache[1]
+    
+    def changed_products(self, events):
+        """Collect the SKUs touched by a set of events and their current product rows"""
+        skus = set()
+        for keyed in events.values():
+            skus.update(keyed)
+        products_df = self.read_products()
+        changed_df = products_df[products_df['SKU'].astype(str).isin(skus)]
+        return skus, changed_df
+    
+    def apply_tree_delta(self, tree, skus, rows, insert_new=True):
+        """Update, insert or delete tree rows for the changed SKUs only"""
+        for sku in skus:
+            if sku in rows:
+                if tree.exists(sku):
+                    tree.item(sku, values=rows[sku])
+                elif insert_new:
+                    tree.insert('', 'end', iid=sku, values=rows[sku])
+            elif tree.exists(sku):
+                tree.delete(sku)
+    
+    def on_products_changed(self, events):
+        """Apply product changes to the products tree"""
+        if self.current_user is None:
+            return
+        skus, changed_df = self.changed_products(events)
+        changed_df = with_stock_totals(changed_df)
+        rows = {str(row['SKU']): self.product_row_values(row) for _, row in changed_df.iterrows()}
+        self.apply_tree_delta(self.products_tree, skus, rows)
+    
+    def on_stock_changed(self, events):
+        """Apply product and stock changes to the stock tree"""
+        if self.current_user is None:
+            return
+        skus, changed_df = self.changed_products(events)
+        self.apply_tree_delta(self.stock_tree, skus, self.stock_row_values(changed_df))
+    
+    def on_billing_products_changed(self, events):
+        """Apply product and stock changes to the billing tree and scan index"""
+        if self.current_user is None:
+            return
+        skus, _ = self.changed_products(events)
+        products_df = self.read_billing_products()
+        changed_df = products_df[products_df['SKU'].astype(str).isin(skus)]
+        
+        rows = {}
+        for _, row in changed_df.iterrows():
+            sku = str(row['SKU'])
+            rows[sku] = self.billing_row_values(row)
+            self.sku_index[sku] = {'sku': row['SKU'], 'name': row['Product_Name'],
+                                   'price': float(row['Price']), 'stock': int(row['Quantity'])}
+        for sku in skus - set(rows):
+            self.sku_index.pop(sku, None)
+        
+        # New products only show up in an unfiltered list
+        insert_new = not self.product_search_entry.get().strip()
+        self.apply_tree_delta(self.billing_products_tree, skus, rows, insert_new)
+    
+    def on_catalog_changed(self, events):
+        """Re-index only the products that were added, renamed or deleted"""
+        skus, changed_df = self.changed_products(events)
+        for sku, name in zip(changed_df['SKU'].astype(str), changed_df['Product_Name']):
+            self.sku_prefix_index.add(sku, name)
+        for sku in skus - set(changed_df['SKU'].astype(str)):
+            self.sku_prefix_index.remove(sku)
+    
+    def on_invoices_created(self, events):
+        """Add new invoices to the top of the invoice history"""
+        if self.current_user is None:
+            return
+        # Keep a customer search applied - only matching invoices are added
+        search_term = self.invoice_search_entry.get().lower()
+        for invoice_id, invoice in events[INVOICE_CREATED].items():
+            if invoice is None or self.invoices_tree.exists(invoice_id):
+                continue
+            if search_term not in str(invoice['Customer_Name']).lower():
+                continue
+            self.invoices_tree.insert('', 0, iid=invoice_id, values=(
+                invoice['Invoice_ID'], invoice['Date'], invoice['Customer_Name'],
+                f"${invoice['Total_Amount']:.2f}", invoice['Payment_Type']
+            ))
     
     def search_products(self):
         """Search products for billing"""
         search_term = self.product_search_entry.get().lower()
         
         try:
-            products_df = pd.read_excel('products.xlsx')
+            products_df = self.read_billing_products()
             
             # Clear existing items
             for item in self.billing_products_tree.get_children():
@@ -729,17 +3509,22 @@ class InventoryManagementApp:
                     search_term in row['SKU'].lower() or
                     search_term in str(row['Category']).lower()):
                     
-                    self.billing_products_tree.insert('', 'end', values=(
-                        row['SKU'], row['Product_Name'], 
-                        f"${row['Price']:.2f}", int(row['Quantity'])
-                    ))
+                    self.billing_products_tree.insert('', 'end', iid=str(row['SKU']),
+                                                      values=self.billing_row_values(row))
         except Exception as e:
             print(f"Error searching products: {e}")
     
+    def read_billing_products(self):
+        """Read products with Quantity replaced by this terminal's location stock"""
+        products_df = self.read_products()
+        local_stock = read_location_stock(TERMINAL_LOCATION)
+        products_df['Quantity'] = products_df['SKU'].astype(str).map(local_stock).fillna(0)
+        return products_df
+    
     def load_billing_products(self):
         """Load all products for billing"""
         try:
-            products_df = pd.read_excel('products.xlsx')
+            products_df = self.read_billing_products()
             
             # Clear existing items
             for item in self.billing_products_tree.get_children():
@@ -747,13 +3532,90 @@ class InventoryManagementApp:
             
             # Add all products
             for _, row in products_df.iterrows():
-                self.billing_products_tree.insert('', 'end', values=(
-                    row['SKU'], row['Product_Name'], 
-                    f"${row['Price']:.2f}", int(row['Quantity'])
-                ))
+                self.billing_products_tree.insert('', 'end', iid=str(row['SKU']),
+                                                  values=self.billing_row_values(row))
+            
+            # Rebuild the scan index from the same read
+            self.sku_index = {
+                str(sku): {'sku': sku, 'name': name, 'price': float(price), 'stock': int(qty)}
+                for sku, name, price, qty in zip(products_df['SKU'], products_df['Product_Name'],
+                                                 products_df['Price'], products_df['Quantity'])
+            }
         except Exception as e:
             print(f"Error loading billing products: {e}")
     
+    def billing_row_values(self, row):
+        """Format a product row for the billing products tree"""
+        return (
+            row['SKU'], row['Product_Name'], 
+            f"${row['Price']:.2f}", int(row['Quantity'])
+        )
+    
+    def on_scan_key(self, event):
+        """Record keystroke timing to tell scanner bursts from manual typing"""
+        if event.keysym != 'Return':
+            self.scan_key_times.append(time.monotonic())
+    
+    def on_scan_enter(self, event):
+        """Handle Enter in the scan field - scanner bursts go straight to the cart"""
+        code = self.scan_entry.get().strip()
+        key_times = self.scan_key_times
+        self.scan_key_times = []
+        self.scan_entry.delete(0, tk.END)
+        
+        if not code:
+            return 'break'
+        
+        intervals = [b - a for a, b in zip(key_times, key_times[1:])]
+        is_scan = (len(code) >= SCAN_MIN_LENGTH and intervals and
+                   max(intervals) <= SCAN_MAX_KEY_INTERVAL)
+        
+        if is_scan or code in self.sku_index:
+            self.scan_add_to_cart(code)
+        else:
+            # Slow manual entry that isn't a SKU - fall back to product search
+            self.product_search_entry.delete(0, tk.END)
+            self.product_search_entry.insert(0, code)
+            self.search_products()
+        return 'break'
+    
+    def scan_add_to_cart(self, code):
+        """Add one unit of a scanned SKU to the cart, or increment its line"""
+        product = self.sku_index.get(code)
+        if product is None:
+            self.root.bell()
+            self.scan_status_label.config(text=f"Unknown SKU: {code}", fg='#f44336')
+            return
+        
+        line = self.cart_rows.get(code)
+        in_cart = sum(item['quantity'] for item in self.cart_items if str(item['sku']) == code)
+        if in_cart + 1 > product['stock']:
+            self.root.bell()
+            self.scan_status_label.config(text=f"Not enough stock: {product['name']}", fg='#f44336')
+            return
+        
+        if line:
+            # Update only the affected row
+            iid, item = line
+            item['quantity'] += 1
+            item['total'] = item['price'] * item['quantity']
+            self.cart_tree.item(iid, values=self.cart_row_values(item))
+        else:
+            item = {
+                'sku': product['sku'],
+                'name': product['name'],
+                'price': product['price'],
+                'quantity': 1,
+                'total': product['price']
+            }
+            self.cart_items.append(item)
+            iid = self.cart_tree.insert('', 'end', values=self.cart_row_values(item))
+            self.cart_rows[code] = (iid, item)
+        
+        self.cart_total += product['price']
+        self.total_label.config(text=f"Total: ${self.cart_total:.2f}")
+        self.scan_status_label.config(text=f"Added {product['name']}", fg='#4CAF50')
+    
     def add_to_cart(self, event):
         """Add selected product to cart"""
         selected = self.billing_products_tree.selection()
@@ -827,18 +3689,24 @@ class InventoryManagementApp:
         
         # Add cart items
         self.cart_total = 0
+        self.cart_rows = {}
         for item in self.cart_items:
-            self.cart_tree.insert('', 'end', values=(
-                item['name'][:15] + '...' if len(item['name']) > 15 else item['name'],
-                item['quantity'],
-                f"${item['price']:.2f}",
-                f"${item['total']:.2f}"
-            ))
+            iid = self.cart_tree.insert('', 'end', values=self.cart_row_values(item))
+            self.cart_rows.setdefault(str(item['sku']), (iid, item))
             self.cart_total += item['total']
         
         # Update total label
         self.total_label.config(text=f"Total: ${self.cart_total:.2f}")
     
+    def cart_row_values(self, item):
+        """Format a cart item for the cart tree"""
+        return (
+            item['name'][:15] + '...' if len(item['name']) > 15 else item['name'],
+            item['quantity'],
+            f"${item['price']:.2f}",
+            f"${item['total']:.2f}"
+        )
+    
     def calculate_change(self):
         """Calculate change amount"""
         try:
@@ -857,47 +3725,227 @@ class InventoryManagementApp:
         customer_name = self.customer_entry.get() or "Walk-in Customer"
         
         try:
-            # Generate invoice ID
-            invoices_df = pd.read_excel('invoices.xlsx')
-            invoice_id = f"INV{len(invoices_df) + 1:04d}"
+            # Scheduled price changes take effect at checkout, even for items already in the cart
+            checkout_time = datetime.now()
+            price_index = self.read_price_index()
+            repriced = False
+            for item in self.cart_items:
+                current = price_index.lookup(item['sku'], checkout_time)
+                if current is not None and current[0] != item['price']:
+                    item['price'] = current[0]
+                    item['total'] = item['price'] * item['quantity']
+                    repriced = True
+            if repriced:
+                self.update_cart_display()
+            
+            # Reserve invoice ID without reading the invoice file
+            invoice_id = self.sales_journal.next_invoice_id()
             
             # Create invoice record
             invoice_data = {
                 'Invoice_ID': invoice_id,
-                'Date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                'Date': checkout_time.strftime('%Y-%m-%d %H:%M:%S'),
                 'Customer_Name': customer_name,
                 'Items': ', '.join([f"{item['name']} x{item['quantity']}" for item in self.cart_items]),
-                'Total_Amount': self.cart_total,
+                'Total_Amount': float(self.cart_total),
                 'Payment_Type': self.payment_var.get()
             }
             
-            # Add to invoices
-            new_invoice = pd.DataFrame([invoice_data])
-            invoices_df = pd.concat([invoices_df, new_invoice], ignore_index=True)
-            invoices_df.to_excel('invoices.xlsx', index=False)
-            
-            # Update stock quantities
-            products_df = pd.read_excel('products.xlsx')
-            for item in self.cart_items:
-                product_idx = products_df[products_df['SKU'] == item['sku']].index[0]
-                current_qty = products_df.loc[product_idx, 'Quantity']
-                new_qty = current_qty - item['quantity']
-                products_df.loc[product_idx, 'Quantity'] = new_qty
-            
-            products_df.to_excel('products.xlsx', index=False)
+            # Journal the sale - invoice and stock files are updated by the background flusher
+            items = [{'sku': str(item['sku']), 'quantity': int(item['quantity']), 'location': TERMINAL_LOCATION}
+                     for item in self.cart_items]
+            self.sales_journal.append(invoice_data, items)
             
             messagebox.showinfo("Success", f"Sale processed successfully!\nInvoice ID: {invoice_id}")
             
-            # Clear cart and refresh displays
+            # Clear cart - displays refresh once the flusher applies the sale
             self.clear_cart()
-            self.load_products()
-            self.load_stock_data()
-            self.load_billing_products()
-            self.load_invoices()
             
         except Exception as e:
             messagebox.showerror("Error", f"Failed to process sale: {str(e)}")
     
+    def poll_sales_journal(self):
+        """Publish change events for sales the background flusher has applied"""
+        while True:
+            try:
+                batch = self.sales_journal.applied_batches.get_nowait()
+            except queue.Empty:
+                break
+            
+            invoices = {entry['invoice']['Invoice_ID']: entry['invoice'] for entry in batch}
+            skus = {item['sku'] for entry in batch for item in entry['items']}
+            self.change_bus.publish(INVOICE_CREATED, invoices, invoices)
+            self.change_bus.publish(STOCK_CHANGED, skus)
+            self.backup_manager.note_sales(len(batch))
+        
+        # Sales are receipted but not reaching the store - say so once, not on every retry
+        if self.sales_journal.failed_flushes >= JOURNAL_ERROR_ALERT_FAILURES:
+            if not self.journal_error_shown:
+                self.journal_error_shown = True
+                messagebox.showerror("Error", f"Sales are not being saved to the inventory files: "
+                                              f"{self.sales_journal.last_error}\n\n"
+                                              f"They are kept in the sales journal and will be retried.")
+        else:
+            self.journal_error_shown = False
+        
+        self.root.after(500, self.poll_sales_journal)
+    
+    def apply_scheduled_prices(self):
+        """Roll scheduled price changes that have come due into the product list"""
+        now = pd.Timestamp.now()
+        try:
+            next_change = self.read_price_index().next_change_after(self.prices_checked_at)
+            if next_change is not None and next_change <= now:
+                with self.sales_journal.store_lock:
+                    skus = apply_due_prices(now)
+                self.change_bus.publish(PRODUCT_UPDATED, skus)
+            self.prices_checked_at = now
+        except Exception as e:
+            print(f"Error applying scheduled prices: {e}")
+        
+        self.root.after(PRICE_CHECK_INTERVAL_SECONDS * 1000, self.apply_scheduled_prices)
+    
+    def show_price_history(self):
+        """Show the selected product's price history and schedule price changes"""
+        selected = self.products_tree.selection()
+        if not selected:
+            messagebox.showerror("Error", "Please select a product")
+            return
+        # Rows are keyed by SKU; the displayed values lose leading zeros
+        sku = selected[0]
+        
+        history_window = tk.Toplevel(self.root)
+        history_window.title(f"Price History - {sku}")
+        history_window.geometry("600x420")
+        history_window.transient(self.root)
+        
+        columns = ('From', 'To', 'Price', 'Cost')
+        history_tree = ttk.Treeview(history_window, columns=columns, show='headings', height=10)
+        for col in columns:
+            history_tree.heading(col, text=col)
+            history_tree.column(col, width=130)
+        history_tree.pack(fill='both', expand=True, padx=10, pady=10)
+        
+        def refresh():
+            for item in history_tree.get_children():
+                history_tree.delete(item)
+            for start, end, price, cost in self.read_price_index().history(sku):
+                history_tree.insert('', 'end', values=(
+                    '' if start == PRICE_HISTORY_START else start.strftime('%Y-%m-%d %H:%M'),
+                    end.strftime('%Y-%m-%d %H:%M') if end is not None else '',
+                    f"${price:.2f}", f"${cost:.2f}"
+                ))
+        
+        form_frame = tk.Frame(history_window)
+        form_frame.pack(pady=5)
+        entries = {}
+        for i, field in enumerate(['Price', 'Cost', 'From (YYYY-MM-DD HH:MM)', 'Until (optional)']):
+            tk.Label(form_frame, text=f"{field}:").grid(row=i // 2, column=(i % 2) * 2, padx=5, pady=3, sticky='e')
+            entry = tk.Entry(form_frame, width=18)
+            entry.grid(row=i // 2, column=(i % 2) * 2 + 1, padx=5, pady=3)
+            entries[field.split()[0].lower()] = entry
+        
+        def schedule():
+            try:
+                price = float(entries['price'].get())
+                cost = float(entries['cost'].get())
+                start = pd.Timestamp(entries['from'].get().strip()) if entries['from'].get().strip() else None
+                end = pd.Timestamp(entries['until'].get().strip()) if entries['until'].get().strip() else None
+            except ValueError:
+                messagebox.showerror("Error", "Enter a valid price, cost and dates", parent=history_window)
+                return
+            
+            try:
+                with self.sales_journal.store_lock:
+                    skus = schedule_price(sku, price, cost, start, end)
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to schedule price: {str(e)}", parent=history_window)
+                return
+            
+            self.change_bus.publish(PRODUCT_UPDATED, skus)
+            refresh()
+        
+        tk.Button(history_window, text="Schedule Price", command=schedule, 
+                 bg='#4CAF50', fg='white').pack(pady=10)
+        refresh()
+    
+    def show_backups(self):
+        """List backup snapshots, take one now or restore one"""
+        backup_window = tk.Toplevel(self.root)
+        backup_window.title("Backups")
+        backup_window.geometry("650x400")
+        backup_window.transient(self.root)
+        
+        columns = ('Created', 'Reason', 'Files', 'Changed', 'New Data')
+        snapshots_tree = ttk.Treeview(backup_window, columns=columns, show='headings', height=12)
+        for col in columns:
+            snapshots_tree.heading(col, text=col)
+            snapshots_tree.column(col, width=110)
+        snapshots_tree.pack(fill='both', expand=True, padx=10, pady=10)
+        
+        status_label = tk.Label(backup_window, text="")
+        status_label.pack()
+        
+        def refresh():
+            for item in snapshots_tree.get_children():
+                snapshots_tree.delete(item)
+            try:
+                for snapshot in list_snapshots():
+                    snapshots_tree.insert('', 'end', iid=snapshot['id'], values=(
+                        snapshot['created'], snapshot['reason'], len(snapshot['files']),
+                        snapshot['changed_files'], f"{snapshot['bytes_written'] / 1024:.1f} KB"
+                    ))
+            except Exception as e:
+                status_label.config(text=f"Error reading backups: {e}")
+        
+        def back_up_now():
+            self.backup_manager.request('manual')
+            status_label.config(text="Backup requested...")
+            backup_window.after(1000, refresh)
+        
+        def restore():
+            selected = snapshots_tree.selection()
+            if not selected:
+                messagebox.showerror("Error", "Please select a snapshot", parent=backup_window)
+                return
+            if self.current_user['role'] != 'Admin':
+                messagebox.showerror("Error", "Only an Admin can restore backups", parent=backup_window)
+                return
+            if not messagebox.askyesno("Confirm", "Restore all data files to this snapshot? "
+                                       "Changes made since then will be lost.", parent=backup_window):
+                return
+            
+            try:
+                # Apply pending sales first so none are replayed on top of the restored files
+                self.sales_journal.flush()
+                with self.sales_journal.store_lock:
+                    snapshot = restore_snapshot(selected[0])
+            except Exception as e:
+                messagebox.showerror("Error", f"Failed to restore backup: {str(e)}", parent=backup_window)
+                return
+            
+            messagebox.showinfo("Success", f"Restored snapshot from {snapshot['created']}", parent=backup_window)
+            backup_window.destroy()
+            self.show_main_interface()
+        
+        button_frame = tk.Frame(backup_window)
+        button_frame.pack(pady=10)
+        tk.Button(button_frame, text="Back Up Now", command=back_up_now, 
+                 bg='#4CAF50', fg='white').pack(side='left', padx=5)
+        tk.Button(button_frame, text="Restore Selected", command=restore, 
+                 bg='#f44336', fg='white').pack(side='left', padx=5)
+        tk.Button(button_frame, text="Refresh", command=refresh).pack(side='left', padx=5)
+        refresh()
+    
+    def on_close(self):
+        """Flush pending sales before the window closes"""
+        self.backup_manager.stop()
+        try:
+            self.sales_journal.close()
+        except Exception as e:
+            messagebox.showerror("Error", f"Failed to flush sales journal: {str(e)}")
+        self.root.destroy()
+    
     def clear_cart(self):
         """Clear the shopping cart"""
         self.cart_items = []
@@ -910,7 +3958,7 @@ class InventoryManagementApp:
     def load_invoices(self):
         """Load invoices into the tree view"""
         try:
-            invoices_df = pd.read_excel('invoices.xlsx')
+            invoices_df = read_invoices()
             
             # Clear existing items
             for item in self.invoices_tree.get_children():
@@ -918,7 +3966,7 @@ class InventoryManagementApp:
             
             # Add invoices to tree (most recent first)
             for _, row in invoices_df.sort_values('Date', ascending=False).iterrows():
-                self.invoices_tree.insert('', 'end', values=(
+                self.invoices_tree.insert('', 'end', iid=str(row['Invoice_ID']), values=(
                     row['Invoice_ID'], row['Date'], row['Customer_Name'],
                     f"${row['Total_Amount']:.2f}", row['Payment_Type']
                 ))
@@ -930,7 +3978,7 @@ class InventoryManagementApp:
         search_term = self.invoice_search_entry.get().lower()
         
         try:
-            invoices_df = pd.read_excel('invoices.xlsx')
+            invoices_df = read_invoices()
             
             # Clear existing items
             for item in self.invoices_tree.get_children():
@@ -939,33 +3987,105 @@ class InventoryManagementApp:
             # Filter and add invoices
             for _, row in invoices_df.iterrows():
                 if search_term in row['Customer_Name'].lower():
-                    self.invoices_tree.insert('', 'end', values=(
+                    self.invoices_tree.insert('', 'end', iid=str(row['Invoice_ID']), values=(
                         row['Invoice_ID'], row['Date'], row['Customer_Name'],
                         f"${row['Total_Amount']:.2f}", row['Payment_Type']
                     ))
         except Exception as e:
             print(f"Error searching invoices: {e}")
     
-    def update_barcode_combo(self):
-        """Update barcode SKU combo box"""
-        try:
-            products_df = pd.read_excel('products.xlsx')
-            sku_list = [f"{row['SKU']} - {row['Product_Name']}" for _, row in products_df.iterrows()]
-            self.barcode_sku_combo['values'] = sku_list
-        except Exception as e:
-            print(f"Error updating barcode combo: {e}")
+    def show_export_dialog(self):
+        """Open the export dialog for invoices and stock reports"""
+        export_window = tk.Toplevel(self.root)
+        export_window.title("Export")
+        export_window.geometry("380x300")
+        export_window.transient(self.root)
+        
+        tk.Label(export_window, text="Report:").pack(pady=5)
+        job_var = tk.StringVar(value='Invoices')
+        ttk.Combobox(export_window, textvariable=job_var, values=list(EXPORT_JOBS),
+                     state='readonly', width=20).pack()
+        
+        tk.Label(export_window, text="Invoice dates from / to (YYYY-MM-DD, optional):").pack(pady=5)
+        date_frame = tk.Frame(export_window)
+        date_frame.pack()
+        start_entry = tk.Entry(date_frame, width=12)
+        start_entry.pack(side='left', padx=5)
+        end_entry = tk.Entry(date_frame, width=12)
+        end_entry.pack(side='left', padx=5)
+        
+        progress_bar = ttk.Progressbar(export_window, length=300, mode='determinate')
+        progress_bar.pack(pady=15)
+        status_label = tk.Label(export_window, text="")
+        status_label.pack()
+        
+        def start_export():
+            try:
+                start = pd.Timestamp(start_entry.get().strip()) if start_entry.get().strip() else None
+                end = pd.Timestamp(end_entry.get().strip()) if end_entry.get().strip() else None
+            except ValueError:
+                messagebox.showerror("Error", "Dates must be in YYYY-MM-DD format", parent=export_window)
+                return
+            
+            path = filedialog.asksaveasfilename(
+                parent=export_window, defaultextension='.csv',
+                filetypes=[("CSV files", "*.csv"), ("Excel files", "*.xlsx")])
+            if not path:
+                return
+            
+            export_button.config(state='disabled')
+            status_label.config(text="Exporting...")
+            self.run_export(EXPORT_JOBS[job_var.get()], path, start, end,
+                            progress_bar, status_label, export_button)
+        
+        export_button = tk.Button(export_window, text="Export", command=start_export,
+                                  bg='#4CAF50', fg='white')
+        export_button.pack(pady=10)
+    
+    def run_export(self, job, path, start, end, progress_bar, status_label, export_button):
+        """Run an export job on a worker thread and report progress back to the dialog"""
+        updates = queue.Queue()
+        
+        def worker():
+            try:
+                rows = job(path, start, end, progress=lambda done, total: updates.put(('progress', done, total)))
+                updates.put(('done', rows, path))
+            except Exception as e:
+                updates.put(('error', str(e), None))
+        
+        def poll():
+            if not progress_bar.winfo_exists():
+                return
+            try:
+                while True:
+                    kind, value, extra = updates.get_nowait()
+                    if kind == 'progress':
+                        progress_bar['value'] = 100 * value / extra if extra else 100
+                        status_label.config(text=f"Processed {value} of {extra} rows")
+                    elif kind == 'done':
+                        progress_bar['value'] = 100
+                        status_label.config(text=f"Exported {value} rows to {os.path.basename(extra)}")
+                        export_button.config(state='normal')
+                        return
+                    else:
+                        status_label.config(text=f"Export failed: {value}")
+                        export_button.config(state='normal')
+                        return
+            except queue.Empty:
+                pass
+            self.root.after(100, poll)
+        
+        threading.Thread(target=worker, name='export', daemon=True).start()
+        poll()
     
     def generate_barcode(self):
         """Generate barcode for selected product"""
-        sku_selection = self.barcode_sku_var.get()
-        if not sku_selection:
+        sku = self.barcode_sku_picker.get_sku()
+        if sku is None:
             messagebox.showerror("Error", "Please select a product")
             return
         
         try:
-            # Extract SKU from selection
-            sku = sku_selection.split(' - ')[0]
-            
             # Generate barcode
             from barcode import Code128
             from barcode.writer import ImageWriter
@@ -982,14 +4102,12 @@ class InventoryManagementApp:
     
     def view_barcode(self):
         """View generated barcode"""
-        sku_selection = self.barcode_sku_var.get()
-        if not sku_selection:
+        sku = self.barcode_sku_picker.get_sku()
+        if sku is None:
             messagebox.showerror("Error", "Please select a product")
             return
         
         try:
-            # Extract SKU from selection
-            sku = sku_selection.split(' - ')[0]
             barcode_path = f"barcodes/{sku}_barcode.png"
             
             if not os.path.exists(barcode_path):
@@ -1019,4 +4137,5 @@ class InventoryManagementApp:
 if __name__ == "__main__":
     root = tk.Tk()
     app = InventoryManagementApp(root)
+    root.protocol('WM_DELETE_WINDOW', app.on_close)
     root.mainloop()
\ No newline at end of file
@@ -0,0 +1,71 @@
+"""Headless bulk ingestion of external orders (web shop, phone orders).
+
+Reads a CSV or JSON-lines file of order lines, validates SKUs and stock for
+the whole file at once, and commits the resulting invoices and stock
+decrements as one batch through its own sales journal. Invoice numbers come
+from the shared counter, so ingestion can run while the POS is open; the
+stock and invoice files are locked across processes while the batch is
+planned and applied.
+Lines that cannot be filled are rejected, or with --backorder filled as far
+as stock allows and the rest recorded in backorders.xlsx. Rejected lines are
+written to a report next to the input file. A dry run only validates and
+reports: it neither opens nor replays a journal.
+
+Usage:
+    python ingest.py orders.csv
+    python ingest.py webshop.jsonl --backorder --data-dir /srv/inventory
+    python ingest.py orders.csv --dry-run
+"""
+import argparse
+import os
+
+from index import SalesJournal, apply_sales_batch, count_invoices, ingest_orders
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Ingest a file of external orders as invoices")
+    parser.add_argument('orders', help="CSV or JSON-lines file with Order_ID, SKU and Quantity per line")
+    parser.add_argument('--data-dir', default='.', help="inventory data directory")
+    parser.add_argument('--journal', default='ingest_journal.jsonl',
+                        help="sales journal to commit through (replayed first); must not be in use")
+    parser.add_argument('--backorder', action='store_true',
+                        help="fill short lines partially and backorder the rest instead of rejecting them")
+    parser.add_argument('--dry-run', action='store_true', help="validate and report without committing")
+    args = parser.parse_args()
+
+    orders_path = os.path.abspath(args.orders)
+    os.chdir(args.data_dir)
+
+    if args.dry_run:
+        plan_df, invoices = ingest_orders(orders_path, None, backorder=args.backorder, dry_run=True)
+    else:
+        journal = SalesJournal(args.journal, apply_sales_batch)
+        try:
+            journal.open(count_invoices)
+        except RuntimeError as e:
+            parser.exit(1, f"{e}\n")
+        try:
+            plan_df, invoices = ingest_orders(orders_path, journal, backorder=args.backorder)
+        finally:
+            # Applies the batch if the flusher has not already
+            journal.close()
+
+    rejected_df = plan_df[plan_df['Reject_Reason'] != '']
+    print(f"Order lines: {len(plan_df)}")
+    print(f"Invoices {'planned' if args.dry_run else 'created'}: {len(invoices)}")
+    if invoices and not args.dry_run:
+        print(f"  {invoices[0]['Invoice_ID']} .. {invoices[-1]['Invoice_ID']}")
+    print(f"Units filled: {plan_df['Filled'].sum()}")
+    print(f"Units backordered: {plan_df['Backordered'].sum()}")
+    print(f"Lines rejected: {len(rejected_df)}")
+    for reason, count in rejected_df['Reject_Reason'].value_counts().items():
+        print(f"  {reason}: {count}")
+
+    if not rejected_df.empty:
+        report_path = f"{os.path.splitext(orders_path)[0]}.rejected.csv"
+        rejected_df.drop(columns=['Filled', 'Backordered', 'Invoice_ID']).to_csv(report_path, index=False)
+        print(f"Rejected lines written to {report_path}")
+
+
+if __name__ == '__main__':
+    main()
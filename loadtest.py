@@ -0,0 +1,233 @@
+"""Headless load test for the inventory data layer.
+
+Simulates several POS terminals running a mix of product search, cart
+building, checkout and stock adjustment against one shared data directory,
+then reports throughput, latency percentiles, errors and a final
+stock-vs-sales consistency check.
+
+Usage:
+    python loadtest.py --data-dir loadtest_data --terminals 4 --duration 30
+    python loadtest.py --data-dir loadtest_data --terminals 8 --processes
+"""
+import argparse
+import os
+import random
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+from index import (LOCATIONS, SalesJournal, apply_sales_batch, apply_stock_changes,
+                   count_invoices, load_stock_matrix, read_invoices,
+                   write_excel_atomic, write_location_stock, INVOICE_DIR)
+
+# Relative weights of each terminal operation
+DEFAULT_MIX = {'search': 5, 'checkout': 3, 'adjust': 1}
+
+
+def prepare_data_dir(data_dir, skus, stock_per_location):
+    """Create a synthetic catalog in data_dir unless one already exists"""
+    os.makedirs(data_dir, exist_ok=True)
+    os.chdir(data_dir)
+    os.makedirs(INVOICE_DIR, exist_ok=True)
+    os.makedirs('stock', exist_ok=True)
+    if os.path.exists('products.xlsx'):
+        return
+
+    sku_values = [f"LT{i:06d}" for i in range(skus)]
+    products_df = pd.DataFrame({
+        'SKU': sku_values,
+        'Product_Name': [f"Load Test Product {i}" for i in range(skus)],
+        'Category': [f"Category {i % 20}" for i in range(skus)],
+        'Price': np.round(np.random.uniform(1, 100, skus), 2),
+        'Cost': np.round(np.random.uniform(0.5, 50, skus), 2),
+        'Quantity': stock_per_location * len(LOCATIONS),
+        'Supplier': 'Load Test',
+        'Min_Stock': 10,
+    })
+    write_excel_atomic(products_df, 'products.xlsx')
+    for location in LOCATIONS:
+        write_location_stock(location, pd.Series(stock_per_location, index=sku_values))
+
+
+def run_terminal(terminal_id, data_dir, duration, mix, flush_interval, seed):
+    """Run one simulated terminal and return its measurements"""
+    os.chdir(data_dir)
+    rng = random.Random(seed)
+    location = LOCATIONS[terminal_id % len(LOCATIONS)]
+
+    products_df = pd.read_excel('products.xlsx')
+    catalog = list(zip(products_df['SKU'].astype(str), products_df['Product_Name'], products_df['Price']))
+
+    journal = SalesJournal(f"sales_journal_t{terminal_id}.jsonl", apply_sales_batch,
+                           flush_interval=flush_interval)
+    journal.open(count_invoices)
+
+    operations = list(mix)
+    weights = [mix[op] for op in operations]
+    latencies = {op: [] for op in operations}
+    errors = {op: 0 for op in operations}
+    invoices = []
+    sold = {}
+    adjusted = {}
+
+    deadline = time.monotonic() + duration
+    while time.monotonic() < deadline:
+        op = rng.choices(operations, weights)[0]
+        started = time.perf_counter()
+        try:
+            if op == 'search':
+                # Same work as search_products: read the catalog and filter it
+                term = rng.choice(catalog)[1].split()[-1].lower()
+                search_df = pd.read_excel('products.xlsx')
+                search_df[search_df['Product_Name'].str.lower().str.contains(term, regex=False)]
+            elif op == 'checkout':
+                cart = rng.sample(catalog, rng.randint(1, min(5, len(catalog))))
+                items = [{'sku': sku, 'quantity': rng.randint(1, 3), 'location': location}
+                         for sku, _, _ in cart]
+                invoice = {
+                    'Invoice_ID': journal.next_invoice_id(),
+                    'Date': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                    'Customer_Name': f"Terminal {terminal_id}",
+                    'Items': ', '.join(f"{name} x{item['quantity']}" for (_, name, _), item in zip(cart, items)),
+                    'Total_Amount': float(sum(price * item['quantity'] for (_, _, price), item in zip(cart, items))),
+                    'Payment_Type': 'Cash',
+                }
+                journal.append(invoice, items)
+                invoices.append(invoice['Invoice_ID'])
+                for item in items:
+                    key = (item['sku'], location)
+                    sold[key] = sold.get(key, 0) + item['quantity']
+            elif op == 'adjust':
+                sku = rng.choice(catalog)[0]
+                qty = rng.randint(1, 5)
+                with journal.store_lock:
+                    apply_stock_changes([(sku, location, qty)])
+                adjusted[(sku, location)] = adjusted.get((sku, location), 0) + qty
+        except Exception as e:
+            # Report the first failure of each kind; the rest are only counted
+            if not errors[op]:
+                print(f"Terminal {terminal_id} {op} failed: {e}")
+            errors[op] += 1
+            continue
+        latencies[op].append(time.perf_counter() - started)
+
+    # Flush outside the timed window so every acknowledged sale reaches the store
+    flush_error = None
+    try:
+        journal.close()
+    except Exception as e:
+        flush_error = str(e)
+
+    return {
+        'terminal': terminal_id,
+        'latencies': latencies,
+        'errors': errors,
+        'invoices': invoices,
+        'sold': sold,
+        'adjusted': adjusted,
+        'flush_error': flush_error,
+    }
+
+
+def check_consistency(initial_matrix, results):
+    """Compare the final store with the initial stock and everything the terminals did"""
+    expected = initial_matrix.copy()
+    for result in results:
+        for (sku, location), qty in result['sold'].items():
+            expected.loc[sku, location] -= qty
+        for (sku, location), qty in result['adjusted'].items():
+            expected.loc[sku, location] += qty
+
+    final_matrix = load_stock_matrix().reindex(index=expected.index, columns=expected.columns, fill_value=0)
+    stock_mismatches = int((final_matrix != expected).to_numpy().sum())
+    lost_units = int((final_matrix - expected).abs().to_numpy().sum())
+
+    # Each terminal stamps its invoices with its own customer name, so a sale is only
+    # counted as stored if that terminal's invoice is there - colliding IDs count as lost
+    acknowledged = {(f"Terminal {result['terminal']}", invoice_id)
+                    for result in results for invoice_id in result['invoices']}
+    acknowledged_count = sum(len(result['invoices']) for result in results)
+    invoices_df = read_invoices()
+    stored = set(zip(invoices_df['Customer_Name'].astype(str), invoices_df['Invoice_ID'].astype(str)))
+    invoice_ids = [invoice_id for result in results for invoice_id in result['invoices']]
+    return {
+        'stock_cells_mismatched': stock_mismatches,
+        'stock_units_off': lost_units,
+        'invoices_acknowledged': acknowledged_count,
+        'invoices_stored': len(invoices_df),
+        'duplicate_invoice_ids': len(invoice_ids) - len(set(invoice_ids)),
+        'sales_lost': acknowledged_count - len(acknowledged & stored),
+    }
+
+
+def print_report(results, duration, consistency):
+    print(f"\n{'Operation':<10} {'Count':>8} {'Errors':>7} {'Ops/s':>9} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}")
+    for op in results[0]['latencies']:
+        samples = np.array([s for result in results for s in result['latencies'][op]]) * 1000
+        errors = sum(result['errors'][op] for result in results)
+        if len(samples):
+            p50, p95, p99 = np.percentile(samples, [50, 95, 99])
+        else:
+            p50 = p95 = p99 = float('nan')
+        print(f"{op:<10} {len(samples):>8} {errors:>7} {len(samples) / duration:>9.1f} "
+              f"{p50:>9.1f} {p95:>9.1f} {p99:>9.1f}")
+
+    flush_errors = [r['flush_error'] for r in results if r['flush_error']]
+    if flush_errors:
+        print(f"\nFinal journal flush failed on {len(flush_errors)} terminal(s): {flush_errors[0]}")
+
+    print("\nConsistency check")
+    for key, value in consistency.items():
+        print(f"  {key.replace('_', ' ')}: {value}")
+    ok = all(consistency[key] == 0 for key in consistency if key not in ('invoices_acknowledged', 'invoices_stored'))
+    print("  result: " + ("OK" if ok and not flush_errors else "INCONSISTENT - sales or stock updates were lost"))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent POS terminals against a data directory")
+    parser.add_argument('--data-dir', default='loadtest_data', help="shared data directory (created if missing)")
+    parser.add_argument('--terminals', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30, help="seconds each terminal runs")
+    parser.add_argument('--processes', action='store_true', help="run terminals as processes instead of threads")
+    parser.add_argument('--skus', type=int, default=1000, help="catalog size when creating a data directory")
+    parser.add_argument('--stock', type=int, default=100000, help="starting stock per SKU per location")
+    parser.add_argument('--flush-interval', type=float, default=2.0, help="journal group-commit interval")
+    parser.add_argument('--mix', default=None,
+                        help="operation weights, e.g. search=5,checkout=3,adjust=1")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    mix = dict(DEFAULT_MIX)
+    if args.mix:
+        for part in args.mix.split(','):
+            op, weight = part.split('=')
+            if op not in DEFAULT_MIX:
+                parser.error(f"unknown operation in --mix: {op}")
+            mix[op] = float(weight)
+
+    data_dir = os.path.abspath(args.data_dir)
+    prepare_data_dir(data_dir, args.skus, args.stock)
+
+    products_df = pd.read_excel('products.xlsx')
+    skus = products_df['SKU'].astype(str)
+    initial_matrix = load_stock_matrix().reindex(skus, fill_value=0)
+
+    executor_class = ProcessPoolExecutor if args.processes else ThreadPoolExecutor
+    mode = 'processes' if args.processes else 'threads'
+    print(f"Running {args.terminals} terminals ({mode}) for {args.duration:g}s against {data_dir}")
+
+    with executor_class(max_workers=args.terminals) as executor:
+        futures = [executor.submit(run_terminal, terminal_id, data_dir, args.duration, mix,
+                                   args.flush_interval, args.seed + terminal_id)
+                   for terminal_id in range(args.terminals)]
+        results = [future.result() for future in futures]
+
+    consistency = check_consistency(initial_matrix, results)
+    print_report(results, args.duration, consistency)
+
+
+if __name__ == '__main__':
+    main()